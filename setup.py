@@ -31,6 +31,7 @@ setup(
     data_files = [
         ('rst2word/templates', ['templates/rst2word.dot', 'templates/rst2word.dotx'])
     ],
-    scripts = ['src/scripts/rst2word.cmd', 'src/scripts/rst2word.py']
+    scripts = ['src/scripts/rst2word.cmd', 'src/scripts/rst2word.py',
+               'src/scripts/rst2word-batch.cmd', 'src/scripts/rst2word-batch.py']
 )
 
@@ -7,9 +7,13 @@ Created on 21 oct. 2010
 
 __docformat__ = 'reStructuredText'
 
+import atexit
 from docutils import writers
 from docutils.transforms import writer_aux
 from rst2wordlib.visitor import WordTranslator
+from rst2wordlib.wrapper import WordPool
+# registers the raw directive with the spreadsheet options
+import rst2wordlib.directives
 
 class Writer(writers.Writer):
 
@@ -25,6 +29,12 @@ class Writer(writers.Writer):
                 {'default': False, 'action': 'store_true'}),
             ('Global scale for all images', ['--image-scale'],
                 {'default': 100, 'type': 'int'}),
+            ('Downsample the images to this resolution at their displayed size '
+             'and recompress them (needs Pillow, 0 inserts the original files)', ['--image-dpi'],
+                {'default': 0, 'type': 'int'}),
+            ('Directory where the downsampled images and the presentation previews '
+             'are kept between runs', ['--image-cache'],
+                {'default': None, 'metavar': '<dir>'}),
             ('Table of Contents depth', ['--toc-depth'],
                 {'default': 3, 'type': 'int'}),   
             ('Headless mode', ['--headless'],
@@ -33,6 +43,41 @@ class Writer(writers.Writer):
                 {'default': 0.2, 'type': 'float'}),
             ('Lateral padding on tables (in cm)', ['--lateral-padding'],
                 {'default': 0.2, 'type': 'float'}),   
+            ('Document generation backend: "word" drives Microsoft Word through COM, '
+             '"docx" writes the .docx file directly (no Word needed, no PDF export)', ['--backend'],
+                {'default': 'word', 'choices': ['word', 'docx'], 'metavar': '<backend>'}),
+            ('Word backend insertion point: "selection" types through the Word selection, '
+             '"range" inserts through document ranges and keeps track of the position itself', ['--cursor'],
+                {'default': 'selection', 'choices': ['selection', 'range'], 'metavar': '<cursor>'}),
+            ('Table column widths: "content" lets Word fit them to the text (slow on large tables), '
+             '"fixed" and "window" use estimated widths, "window" spreads the table over the page', ['--table-fit'],
+                {'default': 'content', 'choices': ['content', 'fixed', 'window'], 'metavar': '<fit>'}),
+            ('Table style of the template used for the tables without a class naming one '
+             '(defined in the bundled .dotx template). Tables are formatted property by property '
+             'when the template does not define it, as the bundled .dot', ['--table-style'],
+                {'default': 'rst2word table', 'metavar': '<style>'}),
+            ('Bookmarks to create: "all" sections and targets, only those "referenced" '
+             'by a link of the document, or "none"', ['--bookmarks'],
+                {'default': 'all', 'choices': ['all', 'referenced', 'none'], 'metavar': '<mode>'}),
+            ('Restart Excel after reading this many workbooks (0 never restarts it)', ['--excel-recycle'],
+                {'default': 20, 'type': 'int'}),
+            ('Presentations included with raw directives: "thumbnail" inserts the preview '
+             'picture of .pptx files, "ole" embeds them (Word backend only)', ['--powerpoint'],
+                {'default': 'thumbnail', 'choices': ['thumbnail', 'ole'], 'metavar': '<mode>'}),
+            ('Keep this many Word instances started between the documents generated by '
+             'the same process (0 starts Word for each document)', ['--word-pool'],
+                {'default': 0, 'type': 'int'}),
+            ('Restart a pooled Word instance after this many documents (0 never restarts it)', ['--word-recycle'],
+                {'default': 50, 'type': 'int'}),
+            ('Restart a pooled Word instance when it uses more memory, in megabytes '
+             '(needs psutil, 0 does not check)', ['--word-max-memory'],
+                {'default': 0, 'type': 'int'}),
+            ('Generate the top-level sections in this many processes, each with its own '
+             'Word instance, and merge them (Word backend only, 0 generates the document at once)', ['--split-jobs'],
+                {'default': 0, 'type': 'int', 'metavar': '<count>'}),
+            ('Directory where the top-level sections are kept between runs, only those '
+             'that changed are generated again (Word backend only, see --split-jobs)', ['--section-cache'],
+                {'default': None, 'metavar': '<dir>'}),
         )
     )
 
@@ -40,15 +85,25 @@ class Writer(writers.Writer):
     def __init__(self):
         writers.Writer.__init__(self)
         self.translator_class = WordTranslator
+        self.word_pool = None
 
     def get_transforms(self):
         return writers.Writer.get_transforms(self) + [writer_aux.Admonitions]
 
     def translate(self):
-        self.visitor = self.translator_class(self.document)
+        settings = self.document.settings
+        if settings.word_pool and settings.backend == "word" and self.word_pool is None:
+            self.word_pool = WordPool(settings.word_pool, settings.word_recycle, settings.word_max_memory)
+            atexit.register(self.word_pool.close)
+        self.visitor = self.translator_class(self.document, self.word_pool)
         try:
             print "Generating word document..."
-            self.document.walkabout(self.visitor)
+            if (settings.split_jobs > 1 or settings.section_cache) and settings.backend == "word":
+                # imported here, the batch module uses this one
+                from rst2wordlib.batch import generateParts
+                generateParts(self.document, self.visitor)
+            else:
+                self.document.walkabout(self.visitor)
             
             if self.visitor.pdf_destination:
                 print "Exporting document to PDF file %s..." % self.visitor.pdf_destination
@@ -58,9 +113,21 @@ class Writer(writers.Writer):
             else:
                 print "Saving document to file %s..." % self.visitor.destination
                 self.visitor.word.saveAs(self.visitor.destination)
+            
+            print "Statistics:"
+            for name, value in sorted(self.visitor.word.stats.items()):
+                print "    %s: %d" % (name, value)
+            if self.word_pool is not None:
+                for name, value in sorted(self.word_pool.stats.items()):
+                    print "    %s: %d" % (name, value)
         finally:
+            if self.visitor.excel_pool is not None:
+                self.visitor.excel_pool.close()
             if self.document.settings.headless or self.visitor.pdf_destination:
                 self.visitor.word.quit()
             else:
                 self.visitor.word.show()
+                if self.word_pool is not None:
+                    # left to the user
+                    self.word_pool.detach(self.visitor.word.wordApp)
 
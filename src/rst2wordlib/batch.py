@@ -0,0 +1,319 @@
+'''
+This file is part of rst2word
+
+Converts many reStructuredText sources in one run: docutils is set up once
+and the same Writer, and so the same Word instance (see WordPool), is used
+for all the documents. The sources are given on the command line (files or
+glob patterns) or in a manifest, one "source [destination]" per line. The
+result and the duration of each conversion are written to a summary file.
+With --jobs, the documents are spread over worker processes, each with its
+own Batch, Word instance and temporary directory. The same workers can
+generate the parts of a single document (see generateParts), which are
+kept between runs with --section-cache.
+
+@author: Robin Jarry
+'''
+from docutils import frontend, io, SettingsSpec
+from docutils.core import Publisher
+import docutils.readers.standalone
+import docutils.parsers.rst
+import rst2wordlib
+from rst2wordlib.visitor import split_parts, index_bookmarks
+from rst2wordlib.sectioncache import SectionCache, sectionKey
+from multiprocessing import Pool, util
+import csv, glob, os.path, shutil, sys, tempfile, time
+
+class BatchSettings(SettingsSpec):
+
+    settings_spec = (
+        'rst2word Batch Options',
+        None,
+        (
+            ('File listing the documents to generate, one "source [destination]" per line, '
+             'relative to the manifest', ['--manifest'],
+                {'default': None, 'metavar': '<file>'}),
+            ('Directory of the documents whose destination is not given '
+             '(by default next to their source)', ['--output-dir'],
+                {'default': None, 'metavar': '<dir>'}),
+            ('Format of the documents whose destination is not given', ['--output-format'],
+                {'default': 'docx', 'choices': ['docx', 'doc', 'pdf'], 'metavar': '<format>'}),
+            ('File where the result of each conversion is written (CSV)', ['--summary'],
+                {'default': 'rst2word-summary.csv', 'metavar': '<file>'}),
+            ('Number of documents generated at the same time, each by its own process '
+             'and Word instance', ['--jobs'],
+                {'default': 1, 'type': 'int', 'metavar': '<count>'}),
+        )
+    )
+
+
+class BatchOptionParser(frontend.OptionParser):
+
+    def check_values(self, values, args):
+        # any number of sources, see listDocuments
+        values._sources = args
+        values._source = values._destination = None
+        frontend.make_paths_absolute(values.__dict__, self.relative_path_settings)
+        values._config_files = self.config_files
+        return values
+
+
+class Batch:
+    """
+    Generates documents one after the other with the same settings, reader,
+    parser and writer. A failed document does not stop the others.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.reader = docutils.readers.standalone.Reader()
+        self.parser = docutils.parsers.rst.Parser()
+        self.writer = rst2wordlib.Writer()
+
+    def convert(self, source, destination):
+        """
+        Returns the result of a conversion: (source, destination, status,
+        seconds, error).
+        """
+        # each document changes its own copy (source, destination...)
+        settings = frontend.Values(self.settings.__dict__.copy())
+        start = time.time()
+        try:
+            publisher = Publisher(reader=self.reader, parser=self.parser, writer=self.writer,
+                                  source_class=io.FileInput, destination_class=io.NullOutput,
+                                  settings=settings)
+            publisher.set_source(source_path=source)
+            publisher.set_destination(destination_path=destination)
+            publisher.publish()
+        except (Exception, SystemExit):
+            return (source, destination, "failed", time.time() - start, errorText(sys.exc_info()[1]))
+        return (source, destination, "ok", time.time() - start, u"")
+
+    def close(self):
+        if self.writer.word_pool is not None:
+            self.writer.word_pool.close()
+
+
+# the Batch of a worker process (see startWorker)
+_worker_batch = None
+
+def startWorker(settings):
+    global _worker_batch
+    _worker_batch = Batch(settings)
+    # run when the worker exits normally (see Pool.close), quits its Word
+    util.Finalize(None, _worker_batch.close, exitpriority=10)
+
+def convertInWorker(document):
+    """
+    Generates a document in a worker process, with a temporary directory
+    of its own that is removed afterwards.
+    """
+    temp = tempfile.mkdtemp(prefix="rst2word-")
+    tempfile.tempdir = temp
+    try:
+        return _worker_batch.convert(*document)
+    finally:
+        tempfile.tempdir = None
+        shutil.rmtree(temp, True)
+
+def convertAll(settings, documents):
+    """
+    Returns the results of the conversions (see Batch.convert), in the
+    order of the documents.
+    """
+    results = []
+    if settings.jobs <= 1 or len(documents) <= 1:
+        batch = Batch(settings)
+        try:
+            for source, destination in documents:
+                print "Converting %s..." % source
+                results.append(batch.convert(source, destination))
+        finally:
+            batch.close()
+        return results
+    if not settings.image_cache:
+        # shared by the workers, whose temporary directories are not
+        settings.image_cache = os.path.join(tempfile.gettempdir(), "rst2word-images")
+    pool = Pool(min(settings.jobs, len(documents)), startWorker, (settings,))
+    try:
+        for result in pool.imap(convertInWorker, documents):
+            print "%s %s (%.2fs)" % (result[2] == "ok" and "Converted" or "Failed", result[0], result[3])
+            results.append(result)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+def convertPart(part):
+    """
+    Generates a part of a document in a worker process. Returns the result
+    of the conversion, the document properties and the kinds of fields
+    found in this part.
+    """
+    index, source, destination = part
+    _worker_batch.settings.split_part = index
+    result = convertInWorker((source, destination))
+    properties, fields = {}, set()
+    visitor = getattr(_worker_batch.writer, "visitor", None)
+    if result[2] == "ok" and visitor is not None:
+        properties, fields = visitor.word.properties, visitor.word.fields
+    return result, properties, fields
+
+def generateParts(document, visitor):
+    """
+    Generates the top-level sections of a document in worker processes,
+    then inserts them in order in the document of the visitor. The parts
+    are generated with the bookmark names of the whole document, so the
+    links between them work once merged. The heading numbers, captions and
+    the TOC are updated with the fields, at the end. With --section-cache,
+    only the parts that are not in the cache are generated.
+    """
+    settings = document.settings
+    parts = split_parts(document)
+    cache = None
+    keys = [None] * len(parts)
+    cached = [None] * len(parts)
+    if settings.section_cache:
+        cache = SectionCache(settings.section_cache)
+        bookmarks, sections = index_bookmarks(document, settings.bookmarks)
+        for index, children in enumerate(parts):
+            keys[index] = sectionKey(children, bookmarks, sections, settings,
+                                     rst2wordlib.Writer.settings_spec, visitor.root_path)
+            cached[index] = cache.get(keys[index])
+    temp = tempfile.mkdtemp(prefix="rst2word-parts-")
+    missing = [(index, settings._source, os.path.join(temp, "part%03d.docx" % index))
+               for index in range(len(parts)) if cached[index] is None]
+    try:
+        if missing:
+            results = generateMissingParts(settings, visitor, missing)
+            for index, (result, _, _) in enumerate(results):
+                if result[2] != "ok":
+                    raise RuntimeError(u"Part %d of %s failed: %s" % (missing[index][0] + 1, toUnicode(result[0]), result[4]))
+            for (index, _, _), (result, properties, fields) in zip(missing, results):
+                print "    %s generated in %.2fs" % (os.path.basename(result[1]), result[3])
+                cached[index] = (result[1], properties, fields)
+                if cache is not None:
+                    cache.put(keys[index], result[1], properties, fields)
+        word = visitor.word
+        for path, properties, fields in cached:
+            for name, value in properties.items():
+                word.setDocProperty(name, value)
+            word.fields.update(fields)
+            word.insertFile(path)
+        print "Updating document fields..."
+        word.updateFields()
+        if cache is not None:
+            word.stats.update(cache.stats)
+    finally:
+        shutil.rmtree(temp, True)
+
+def generateMissingParts(settings, visitor, parts):
+    """
+    Returns the results of convertPart for the given parts of a document.
+    """
+    part_settings = frontend.Values(settings.__dict__.copy())
+    part_settings.split_jobs = 0
+    part_settings.section_cache = None
+    part_settings.headless = True
+    part_settings.traceback = True
+    part_settings.word_pool = part_settings.word_pool or 1
+    if not part_settings.image_cache:
+        part_settings.image_cache = visitor.image_cache()
+    pool = Pool(max(1, min(settings.split_jobs, len(parts))), startWorker, (part_settings,))
+    try:
+        return pool.map(convertPart, parts, 1)
+    finally:
+        pool.close()
+        pool.join()
+
+def listDocuments(settings):
+    """
+    Returns the (source, destination) of the documents to generate.
+    """
+    documents = []
+    for pattern in settings._sources:
+        sources = sorted(glob.glob(pattern)) or [pattern]
+        for source in sources:
+            documents.append((os.path.abspath(source), None))
+    if settings.manifest:
+        root = os.path.dirname(os.path.abspath(settings.manifest))
+        f = open(settings.manifest, "r")
+        try:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                fields = line.split(None, 1)
+                source = os.path.join(root, fields[0])
+                destination = None
+                if len(fields) > 1:
+                    destination = os.path.join(root, fields[1].strip())
+                documents.append((os.path.normpath(source), destination and os.path.normpath(destination)))
+        finally:
+            f.close()
+    result = []
+    for source, destination in documents:
+        if destination is None:
+            name = os.path.splitext(os.path.basename(source))[0] + "." + settings.output_format
+            directory = settings.output_dir or os.path.dirname(source)
+            destination = os.path.join(os.path.abspath(directory), name)
+        result.append((source, destination))
+    return result
+
+def writeSummary(path, results):
+    f = open(path, "wb")
+    try:
+        writer = csv.writer(f)
+        writer.writerow(["source", "destination", "status", "seconds", "error"])
+        for source, destination, status, seconds, error in results:
+            writer.writerow([toUnicode(value).encode("utf-8")
+                             for value in (source, destination, status, "%.2f" % seconds, error)])
+    finally:
+        f.close()
+
+def toUnicode(value):
+    """
+    Paths and messages can be byte strings of the file system encoding.
+    """
+    if isinstance(value, unicode):
+        return value
+    try:
+        return str(value).decode(sys.getfilesystemencoding() or "utf-8")
+    except UnicodeDecodeError:
+        # an ASCII locale with UTF-8 file names
+        return str(value).decode("utf-8", "replace")
+
+def errorText(error):
+    """
+    Returns "<type>: <message>" for an exception, whatever its message is
+    made of.
+    """
+    try:
+        message = unicode(error)
+    except UnicodeError:
+        # byte strings that are not ASCII
+        message = u", ".join([toUnicode(arg) for arg in error.args])
+    return u"%s: %s" % (error.__class__.__name__, message)
+
+def main(argv=None):
+    parser = BatchOptionParser(components=(docutils.parsers.rst.Parser,
+                                           docutils.readers.standalone.Reader,
+                                           rst2wordlib.Writer, BatchSettings),
+                               usage="%prog [options] [<source>...]",
+                               description="Generates Microsoft Word documents from many "
+                                           "reStructuredText sources (files or glob patterns).")
+    settings = parser.parse_args(argv)
+    # nobody is there to look at the documents, keep Word for the next one
+    settings.headless = True
+    # errors are reported in the summary instead of ending the run
+    settings.traceback = True
+    settings.word_pool = settings.word_pool or 1
+
+    documents = listDocuments(settings)
+    if not documents:
+        parser.error("No source given")
+    results = convertAll(settings, documents)
+    writeSummary(settings.summary, results)
+
+    failed = [result for result in results if result[2] != "ok"]
+    print "%d documents generated, %d failed (see %s)" % (len(results) - len(failed), len(failed), settings.summary)
+    return failed and 1 or 0
@@ -0,0 +1,55 @@
+'''
+This file is part of rst2word
+
+The raw directive, with the options of the spreadsheets it can include:
+:sheet: (name or number of the sheet, the active one by default) and
+:range: (cells to include, the used range of the sheet by default), and of
+the presentations: :image: (picture part of the package to show instead
+of its preview).
+Included files are not read by the directive, only their path is kept:
+rst2word reads them itself, by chunks for the text ones, and reports the
+sheets and parts they do not have.
+
+@author: Robin Jarry
+'''
+from docutils import nodes
+from docutils.parsers.rst import directives
+from docutils.parsers.rst.directives import misc
+from rst2wordlib.spreadsheets import parseRange
+import os.path
+
+class Raw(misc.Raw):
+
+    option_spec = dict(misc.Raw.option_spec, 
+                       sheet=directives.unchanged, 
+                       range=directives.unchanged, 
+                       image=directives.unchanged)
+
+    def run(self):
+        format = " ".join(self.arguments[0].lower().split())
+        if "file" not in self.options:
+            return misc.Raw.run(self)
+        settings = self.state.document.settings
+        if not (settings.raw_enabled and settings.file_insertion_enabled):
+            raise self.warning('"%s" directive disabled.' % self.name)
+        if self.content:
+            raise self.error('"%s" directive may not both specify an external file '
+                             'and have content.' % self.name)
+        source_dir = os.path.dirname(os.path.abspath(self.state.document.current_source))
+        path = os.path.normpath(os.path.join(source_dir, self.options["file"]))
+        if not os.path.isfile(path):
+            raise self.severe('Problems with "%s" directive path: %s not found.' % (self.name, path))
+        if "range" in self.options:
+            try:
+                parseRange(self.options["range"])
+            except ValueError, e:
+                raise self.error('Error in "%s" directive: %s.' % (self.name, e))
+        settings.record_dependencies.add(path)
+        raw_node = nodes.raw("", "", format=format, source=path)
+        for name in ("sheet", "range", "image", "encoding"):
+            if name in self.options:
+                raw_node[name] = self.options[name]
+        raw_node.source, raw_node.line = self.state_machine.get_source_and_line(self.lineno)
+        return [raw_node]
+
+directives.register_directive("raw", Raw)
@@ -0,0 +1,348 @@
+'''
+This file is part of rst2word
+
+Reads the size and resolution of JPEG, PNG, GIF and BMP pictures from their
+headers, without decoding them, so that the translator knows how big an
+image will be before inserting it. Optionally downsamples them to the
+resolution they need in the document (ImageResampler). Also extracts the
+preview pictures of PowerPoint packages (extractThumbnail).
+
+@author: Robin Jarry
+'''
+try:
+    from PIL import Image
+except ImportError:
+    # Pillow is only needed to resample pictures (--image-dpi)
+    Image = None
+from multiprocessing.pool import ThreadPool
+import os.path, posixpath, struct, hashlib, threading, zipfile
+import xml.etree.ElementTree as ElementTree
+
+# resolution used by Word when a picture does not record one
+DEFAULT_DPI = 96.0
+
+JPEG_SOF_MARKERS = (b"\xc0", b"\xc1", b"\xc2", b"\xc3", b"\xc5", b"\xc6", b"\xc7",
+                    b"\xc9", b"\xca", b"\xcb", b"\xcd", b"\xce", b"\xcf")
+
+# path -> (mtime, size, info)
+_cache = {}
+
+JPEG_QUALITY = 85
+
+THUMBNAIL_TYPE = "http://schemas.openxmlformats.org/package/2006/relationships/metadata/thumbnail"
+
+class ImageInfo:
+
+    def __init__(self, width, height, xdpi=None, ydpi=None):
+        self.width = width
+        self.height = height
+        self.xdpi = xdpi or DEFAULT_DPI
+        self.ydpi = ydpi or DEFAULT_DPI
+
+    def size(self, scale=100.0):
+        """
+        Returns the (width, height) in points at which Word displays the
+        picture, multiplied by scale percent.
+        """
+        return (self.width * 72.0 / self.xdpi * scale / 100.0,
+                self.height * 72.0 / self.ydpi * scale / 100.0)
+
+
+def readImageInfo(path):
+    """
+    Returns the ImageInfo of a picture, None if its format is not
+    supported. Results are cached until the file changes.
+    """
+    stat = os.stat(path)
+    cached = _cache.get(path)
+    if cached is not None and cached[:2] == (stat.st_mtime, stat.st_size):
+        return cached[2]
+    f = open(path, "rb")
+    try:
+        head = f.read(26)
+        if head[:8] == b"\x89PNG\r\n\x1a\n":
+            info = readPng(f)
+        elif head[:6] in (b"GIF87a", b"GIF89a"):
+            info = ImageInfo(littleEndian(head[6:8]), littleEndian(head[8:10]))
+        elif head[:2] == b"\xff\xd8":
+            info = readJpeg(f)
+        elif head[:2] == b"BM":
+            info = readBmp(f)
+        else:
+            info = None
+    finally:
+        f.close()
+    _cache[path] = (stat.st_mtime, stat.st_size, info)
+    return info
+
+
+
+class ImageResampler:
+    """
+    Downsamples pictures to the resolution they need at their displayed
+    size and recompresses them, in a pool of threads so that it happens
+    while the document is being generated. Results are kept in cache_dir,
+    named after the hash of the picture and of the parameters.
+    """
+
+    def __init__(self, dpi, cache_dir, threads=4):
+        if Image is None:
+            raise ImportError("Pillow is required to resample images (--image-dpi)")
+        self.dpi = dpi
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.pool = ThreadPool(threads)
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.stats = {"images resampled": 0, "images from cache": 0, "images kept": 0}
+
+    def submit(self, path, size):
+        """
+        Starts resampling the picture for a (width, height) in points.
+        """
+        key = (path, size)
+        if key not in self.jobs:
+            self.jobs[key] = self.pool.apply_async(self.resample, key)
+
+    def get(self, path, size):
+        """
+        Returns the path of the picture to insert, waiting for it if needed.
+        """
+        self.submit(path, size)
+        return self.jobs[(path, size)].get()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def resample(self, path, size):
+        info = readImageInfo(path)
+        width = int(round(size[0] / 72.0 * self.dpi))
+        height = int(round(size[1] / 72.0 * self.dpi))
+        if info is None or (info.width <= width and info.height <= height):
+            self.count("images kept")
+            return path
+
+        f = open(path, "rb")
+        try:
+            digest = hashlib.sha1(f.read())
+        finally:
+            f.close()
+        digest.update(("%d:%d:%d:%d" % (width, height, self.dpi, JPEG_QUALITY)).encode("ascii"))
+        image = Image.open(path)
+        if image.format == "JPEG":
+            extension = ".jpg"
+        else:
+            extension = ".png"
+        target = os.path.join(self.cache_dir, digest.hexdigest() + extension)
+        if os.path.exists(target):
+            self.count("images from cache")
+            return target
+
+        if image.mode not in ("RGB", "RGBA", "L", "LA"):
+            image = image.convert(extension == ".jpg" and "RGB" or "RGBA")
+        image = image.resize((width, height), Image.ANTIALIAS)
+        # written under another name first, other runs may read the cache
+        temp = "%s.%d.%d.tmp" % (target, os.getpid(), threading.current_thread().ident)
+        if extension == ".jpg":
+            image.save(temp, "JPEG", quality=JPEG_QUALITY, optimize=True, dpi=(self.dpi, self.dpi))
+        else:
+            image.save(temp, "PNG", optimize=True, dpi=(self.dpi, self.dpi))
+        try:
+            os.rename(temp, target)
+        except OSError:
+            # already written by someone else (windows does not replace)
+            os.remove(temp)
+        self.count("images resampled")
+        return target
+
+    def count(self, name):
+        self.lock.acquire()
+        try:
+            self.stats[name] += 1
+        finally:
+            self.lock.release()
+
+
+
+#################################################################
+#### POWERPOINT #################################################
+#################################################################
+
+def extractThumbnail(path, cache_dir, part=None):
+    """
+    Extracts the preview picture of a PowerPoint package (.pptx), or the
+    given picture part of it ("ppt/media/image2.png"), to cache_dir and
+    returns its path. Returns None if the file is not a package or has no
+    preview. Pictures are named after the checksum of their content so
+    they are only written once.
+    """
+    if not zipfile.is_zipfile(path):
+        return None
+    package = zipfile.ZipFile(path)
+    try:
+        if part is None:
+            part = thumbnailPart(package)
+            if part is None:
+                return None
+        try:
+            info = package.getinfo(part)
+        except KeyError:
+            raise ValueError("The package has no part %s" % part)
+        digest = hashlib.sha1(("%s:%08x:%d" % (part, info.CRC, info.file_size)).encode("utf-8"))
+        target = os.path.join(cache_dir, digest.hexdigest() + posixpath.splitext(part)[1].lower())
+        if os.path.exists(target):
+            return target
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # written under another name first, other runs may read the cache
+        temp = "%s.%d.%d.tmp" % (target, os.getpid(), threading.current_thread().ident)
+        f = open(temp, "wb")
+        try:
+            f.write(package.read(part))
+        finally:
+            f.close()
+        try:
+            os.rename(temp, target)
+        except OSError:
+            # already written by someone else (windows does not replace)
+            os.remove(temp)
+        return target
+    finally:
+        package.close()
+
+def thumbnailPart(package):
+    names = package.namelist()
+    if "_rels/.rels" in names:
+        for rel in ElementTree.fromstring(package.read("_rels/.rels")):
+            if rel.get("Type") == THUMBNAIL_TYPE:
+                part = rel.get("Target").lstrip("/")
+                if part in names:
+                    return part
+    for name in names:
+        if name.startswith("docProps/thumbnail."):
+            return name
+    return None
+
+
+
+#################################################################
+#### FORMATS ####################################################
+#################################################################
+
+def readPng(f):
+    f.seek(8)
+    width = height = None
+    xdpi = ydpi = None
+    while True:
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            break
+        length, type = bigEndian(chunk[:4]), chunk[4:]
+        if type == b"IHDR":
+            data = f.read(8)
+            width, height = bigEndian(data[:4]), bigEndian(data[4:8])
+            f.seek(length - 8 + 4, 1)
+        elif type == b"pHYs":
+            data = f.read(9)
+            if data[8:9] == b"\x01":
+                # pixels per meter
+                xdpi = round(bigEndian(data[:4]) * 0.0254)
+                ydpi = round(bigEndian(data[4:8]) * 0.0254)
+            f.seek(length - 9 + 4, 1)
+        elif type in (b"IDAT", b"IEND"):
+            # pHYs always comes before the image data
+            break
+        else:
+            f.seek(length + 4, 1)
+    if width is None:
+        return None
+    return ImageInfo(width, height, xdpi, ydpi)
+
+def readJpeg(f):
+    f.seek(2)
+    xdpi = ydpi = None
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0:1] != b"\xff":
+            return None
+        length = bigEndian(f.read(2))
+        if marker[1:2] in JPEG_SOF_MARKERS:
+            data = f.read(5)
+            return ImageInfo(bigEndian(data[3:5]), bigEndian(data[1:3]), xdpi, ydpi)
+        data = f.read(length - 2)
+        if marker[1:2] == b"\xe0" and data[:5] == b"JFIF\x00" and xdpi is None:
+            units = data[7:8]
+            x, y = bigEndian(data[8:10]), bigEndian(data[10:12])
+            if units == b"\x01":
+                xdpi, ydpi = x, y
+            elif units == b"\x02":
+                xdpi, ydpi = round(x * 2.54), round(y * 2.54)
+        elif marker[1:2] == b"\xe1" and data[:6] == b"Exif\x00\x00":
+            resolution = readExifResolution(data[6:])
+            if resolution is not None:
+                xdpi, ydpi = resolution
+
+def readExifResolution(tiff):
+    """
+    Returns the (xdpi, ydpi) stored in the first IFD of an Exif block.
+    """
+    if tiff[:2] == b"II":
+        order = "<"
+    elif tiff[:2] == b"MM":
+        order = ">"
+    else:
+        return None
+    try:
+        offset = struct.unpack(order + "I", tiff[4:8])[0]
+        count = struct.unpack(order + "H", tiff[offset:offset + 2])[0]
+        values = {}
+        for i in range(count):
+            entry = tiff[offset + 2 + i * 12:offset + 14 + i * 12]
+            tag, type = struct.unpack(order + "HH", entry[:4])
+            if tag in (0x011a, 0x011b) and type == 5:
+                # RATIONAL stored at an offset
+                pointer = struct.unpack(order + "I", entry[8:12])[0]
+                numerator, denominator = struct.unpack(order + "II", tiff[pointer:pointer + 8])
+                values[tag] = denominator and float(numerator) / denominator
+            elif tag == 0x0128:
+                values[tag] = struct.unpack(order + "H", entry[8:10])[0]
+    except struct.error:
+        return None
+    xdpi, ydpi = values.get(0x011a), values.get(0x011b)
+    if not (xdpi and ydpi):
+        return None
+    if values.get(0x0128) == 3:
+        # centimeters
+        xdpi, ydpi = xdpi * 2.54, ydpi * 2.54
+    return xdpi, ydpi
+
+def readBmp(f):
+    f.seek(14)
+    data = f.read(32)
+    header_size = littleEndian(data[:4])
+    if header_size == 12:
+        # OS/2 BITMAPCOREHEADER, no resolution
+        return ImageInfo(littleEndian(data[4:6]), littleEndian(data[6:8]))
+    width, height = struct.unpack("<ii", data[4:12])
+    xppm, yppm = struct.unpack("<ii", data[24:32])
+    xdpi = xppm > 0 and round(xppm * 0.0254) or None
+    ydpi = yppm > 0 and round(yppm * 0.0254) or None
+    # negative heights are top-down bitmaps
+    return ImageInfo(width, abs(height), xdpi, ydpi)
+
+
+
+#################################################################
+#### UTIL METHODS ###############################################
+#################################################################
+
+def bigEndian(data):
+    value = 0
+    for c in bytearray(data):
+        value = (value << 8) | c
+    return value
+
+def littleEndian(data):
+    return bigEndian(bytes(bytearray(reversed(bytearray(data)))))
@@ -0,0 +1,1012 @@
+'''
+This file is part of rst2word
+
+Native Office Open XML writer. Implements the same operations as
+rst2wordlib.wrapper.Word but builds the WordprocessingML parts in memory and
+writes them straight into a .docx package. No Word installation is needed.
+
+@author: Robin Jarry
+'''
+from rst2wordlib.constants import Constants as CST
+from rst2wordlib.images import readImageInfo
+from xml.sax.saxutils import escape, quoteattr
+from xml.etree import ElementTree
+from distutils import dir_util
+import os.path, re, zipfile, datetime
+
+W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+R_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+WP_NS = "http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing"
+A_NS = "http://schemas.openxmlformats.org/drawingml/2006/main"
+PIC_NS = "http://schemas.openxmlformats.org/drawingml/2006/picture"
+PKG_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+REL_TYPE = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/"
+
+TEMPLATE_MAIN_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.template.main+xml"
+DOCUMENT_MAIN_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"
+CUSTOM_PROPS_TYPE = "application/vnd.openxmlformats-officedocument.custom-properties+xml"
+
+IMAGE_TYPES = {
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "gif": "image/gif",
+    "bmp": "image/bmp",
+}
+
+# built-in properties and the core.xml/app.xml element that holds them
+BUILTIN_PROPERTIES = {
+    "Title": "dc:title",
+    "Subject": "dc:subject",
+    "Author": "dc:creator",
+    "Comments": "dc:description",
+    "Revision number": "cp:revision",
+    "Company": "Company",
+}
+
+# styles are given as wdStyle constants, templates refer to them with their
+# english built-in name (the style ids are localized)
+BUILTIN_STYLE_NAMES = {
+    CST.wdStyleNormal: "normal",
+    CST.wdStyleDefaultParagraphFont: "default paragraph font",
+    CST.wdStyleBodyText: "body text",
+    CST.wdStyleBodyText2: "body text 2",
+    CST.wdStyleBodyText3: "body text 3",
+    CST.wdStyleBodyTextIndent: "body text indent",
+    CST.wdStyleBodyTextIndent2: "body text indent 2",
+    CST.wdStyleBodyTextIndent3: "body text indent 3",
+    CST.wdStyleCaption: "caption",
+    CST.wdStyleEmphasis: "emphasis",
+    CST.wdStyleStrong: "strong",
+    CST.wdStyleHtmlCode: "html code",
+    CST.wdStyleHtmlPre: "html preformatted",
+    CST.wdStyleSubtitle: "subtitle",
+    CST.wdStyleTitle: "title",
+    CST.wdStyleListBullet: "list bullet",
+    CST.wdStyleListNumber: "list number",
+}
+for _i in range(1, 10):
+    BUILTIN_STYLE_NAMES[getattr(CST, "wdStyleHeading%d" % _i)] = "heading %d" % _i
+for _i in range(2, 6):
+    BUILTIN_STYLE_NAMES[getattr(CST, "wdStyleListBullet%d" % _i)] = "list bullet %d" % _i
+    BUILTIN_STYLE_NAMES[getattr(CST, "wdStyleListNumber%d" % _i)] = "list number %d" % _i
+
+ALIGNMENTS = {
+    CST.wdAlignParagraphLeft: "left",
+    CST.wdAlignParagraphCenter: "center",
+    CST.wdAlignParagraphRight: "right",
+    CST.wdAlignParagraphJustify: "both",
+}
+
+ROW_ALIGNMENTS = {
+    CST.wdAlignRowLeft: "left",
+    CST.wdAlignRowCenter: "center",
+    CST.wdAlignRowRight: "right",
+}
+
+ILLEGAL_XML_REX = re.compile(u"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+NEWLINE_REX = re.compile(r"\r\n|\r|\n")
+
+EMU_PER_POINT = 12700
+TWIPS_PER_POINT = 20
+
+
+class Docx:
+    """
+    Same interface as rst2wordlib.wrapper.Word. The document is kept as a
+    list of blocks (paragraphs and tables), the "selection" is always at the
+    end of the current paragraph.
+    """
+
+    def __init__(self, templatefile=None):
+        if templatefile is None or not zipfile.is_zipfile(templatefile):
+            raise ValueError("The docx backend needs a .dotx/.docx template, got %r" % templatefile)
+        self.template = Template(templatefile)
+
+        self.body = []
+        self.container = self.body
+        self.tables = []
+        self.paragraph = None
+        self.char_style = None
+        self.font = set()
+        self.anchors = {}
+        self.bookmarks = []
+        self.images = {}
+        self.properties = {}
+        self.numbering = {}
+        self.restarts = []
+        self.has_toc = False
+        self.update_fields = False
+        self.next_id = 1
+        self.stats = {"text insertions": 0, "runs": 0}
+        self._newParagraph(None, None)
+
+    def show(self):
+        # nothing to show, there is no GUI
+        pass
+
+    def quit(self, saveChanges=False):
+        pass
+
+    def getStyleList(self):
+        self.styles = [s.name for s in self.template.styles.values()]
+        return self.styles
+
+    def saveAs(self, filename):
+        dir = os.path.abspath(os.path.dirname(filename))
+        if not os.path.exists(dir):
+            dir_util.mkpath(dir)
+        Package(self, self.template).write(filename)
+
+    def selectEnd(self):
+        pass
+
+    def addText(self, text):
+        self.stats["text insertions"] += 1
+        items = self.paragraph.items
+        if items and isinstance(items[-1], Run) and items[-1].hasFormat(self.char_style, self.font):
+            # same formatting as the previous run, no need for a new one
+            items[-1].text += text
+            return
+        items.append(Run(text, self.char_style, self.font))
+        self.stats["runs"] += 1
+
+    def addTextChunks(self, chunks):
+        # a run per chunk, they would be concatenated over and over otherwise
+        for chunk in chunks:
+            self.stats["text insertions"] += 1
+            self.paragraph.items.append(Run(chunk, self.char_style, self.font))
+            self.stats["runs"] += 1
+
+    def addStyledText(self, text, style):
+        self.setStyle(style)
+        self.addText(text)
+        self.char_style = None
+
+    def addTable(self, rows, cols, fit=CST.wdAutoFitContent):
+        if not self.paragraph.isEmpty():
+            self.newParagraph()
+        table = Table(rows, cols, self.paragraph.style, self.paragraph.align)
+        table.fit = fit
+        table.outer = self.container
+        table.after = self.paragraph
+        self.container.insert(self._indexOf(self.paragraph), table)
+        self.tables.append(table)
+        self._enterCell(table, 0, 0)
+        return table
+
+    def beginTable(self, rows, cols, fit=CST.wdAutoFitContent):
+        self.addTable(rows, cols, fit)
+
+    def nextCell(self):
+        self.move("right", CST.wdCell)
+
+    def nextRow(self):
+        self.move("right", CST.wdCell)
+
+    def endTable(self):
+        table = self.tables[-1]
+        self.move("down", CST.wdLine)
+        return table
+
+    def boldRows(self, table, count):
+        for row in table.cells[:count]:
+            for cell in row:
+                setBold(cell)
+
+    def formatColumn(self, table, index, bold=False, alignment=None):
+        for row in table.cells:
+            cell = row[index - 1]
+            if bold:
+                setBold(cell)
+            if alignment is not None:
+                for block in cell:
+                    if isinstance(block, Paragraph):
+                        block.align = ALIGNMENTS.get(alignment)
+
+    def setDocProperty(self, name, value):
+        self.properties[name] = value
+
+    def getDocProperty(self, name):
+        return self.properties.get(name, "")
+
+    def flushDocProperties(self):
+        # properties are written along with the package
+        return len(self.properties)
+
+    def insertField(self, doc_property_name):
+        self.paragraph.items.append(PropertyField(doc_property_name, self.char_style, self.font))
+
+    def setStyle(self, style):
+        s = self.template.getStyle(style)
+        if s is None:
+            return
+        if s.type == "character":
+            if s.default:
+                # like Ctrl+Space, resets the direct character formatting
+                self.char_style = None
+                self.font = set()
+            else:
+                self.char_style = s.id
+        elif s.type == "paragraph":
+            self._setParagraphStyle(s.id)
+
+    def setFont(self, font):
+        # emulates Font.<attr> = wdToggle
+        if font in self.font:
+            self.font.discard(font)
+        else:
+            self.font.add(font)
+            if font == "Superscript":
+                self.font.discard("Subscript")
+            elif font == "Subscript":
+                self.font.discard("Superscript")
+
+    def insertTableOfContents(self, depth=3):
+        self.paragraph.items.append(TocField(depth))
+        self.has_toc = True
+
+    def updateFields(self):
+        # DOCPROPERTY results are computed when writing the package,
+        # only the TOC needs Word to refresh it when the document is opened
+        self.update_fields = self.has_toc
+
+    def insertPageBreak(self):
+        self.paragraph.items.append(Break("page"))
+
+    def newParagraph(self):
+        style = self.template.styles.get(self.paragraph.style)
+        if style is not None and style.next:
+            next_style = style.next
+        else:
+            next_style = self.paragraph.style
+        self._newParagraph(next_style, self.paragraph.align)
+
+    def setAlignment(self, alignment):
+        self.paragraph.align = ALIGNMENTS.get(alignment)
+
+    def insertImage(self, image_path, size=None):
+        if size is None:
+            info = readImageInfo(image_path)
+            if info is None:
+                raise ValueError("Unsupported image format: %s" % image_path)
+            size = info.size()
+        if image_path not in self.images:
+            self.images[image_path] = "media/rst2word_image%d%s" % (len(self.images) + 1,
+                                                                   os.path.splitext(image_path)[1].lower())
+        image = InlineImage(image_path, self._nextId(), size[0], size[1])
+        self.paragraph.items.append(image)
+        return image
+
+    def scaleImage(self, image, scale=100.0):
+        image.LockAspectRatio = -1
+        image.Width = image.Width * (scale / 100.0)
+        image.Height = image.Height * (scale / 100.0)
+
+    def addCaption(self, text, figure, auto=False, label="Figure"):
+        self.setStyle(CST.wdStyleCaption)
+        if auto:
+            self.addText(label + " ")
+            self.paragraph.items.append(SequenceField(label))
+            self.addText(" " + text)
+        self.newParagraph()
+        self.clearFormatting()
+
+    def move(self, direction, unit=CST.wdCell, count=1):
+        if not self.tables or self.container is not self.tables[-1].cell:
+            return
+        table = self.tables[-1]
+        if unit == CST.wdCell:
+            index = table.row * table.cols + table.col
+            if direction in ("right", "down"):
+                index += count
+            else:
+                index -= count
+            index = max(0, min(index, table.rows * table.cols - 1))
+            self._enterCell(table, index // table.cols, index % table.cols)
+        elif direction == "down":
+            # leave the table, the cursor lands on the paragraph that follows it
+            self.tables.pop()
+            self.container = table.outer
+            self.paragraph = table.after
+            self.char_style = None
+            self.font = set()
+
+    def formatTables(self, style=None, fit=CST.wdAutoFitContent, align=CST.wdAlignRowCenter):
+        for t in self.allTables():
+            t.fit = fit
+            t.align = ROW_ALIGNMENTS.get(align)
+
+    def formatTable(self, table, lateral_padding=0.25, vertical_padding=0.15,
+                    border=False, first_row_bg_color=CST.wdColorAutomatic,
+                    fit=CST.wdAutoFitContent, align=CST.wdAlignRowCenter, widths=None, style=None):
+        if first_row_bg_color != CST.wdColorAutomatic:
+            table.heading = True
+        if style is not None:
+            # borders, shading and padding come from the template
+            table.style = self.template.getStyleId(style)
+        else:
+            table.padding = (CentimetersToTwips(vertical_padding), CentimetersToTwips(lateral_padding))
+            table.border = border
+            if first_row_bg_color != CST.wdColorAutomatic:
+                table.header_color = wordColorToHex(first_row_bg_color)
+        table.fit = fit
+        table.align = ROW_ALIGNMENTS.get(align)
+        if widths:
+            table.widths = [int(width * 20) for width in widths]
+
+    def getTextWidth(self):
+        return self.template.text_width / 20.0
+
+    def hasTableStyle(self, name):
+        style = self.template.getStyle(name)
+        return style is not None and style.type == "table"
+
+    def fitTables(self, fit=CST.wdAutoFitContent):
+        for t in self.allTables():
+            t.fit = fit
+
+    def allTables(self):
+        return [b for b in walkBlocks(self.body) if isinstance(b, Table)]
+
+    def insertBookmark(self, name, start=0, end=0):
+        if start and end:
+            start_anchor = self.anchors[start]
+            end_anchor = self.anchors[end]
+        else:
+            start_anchor = end_anchor = self.anchors[self.getCurrentPosition()]
+        bookmark_id = len(self.bookmarks)
+        self.bookmarks.append(name)
+        start_anchor.starts.append((bookmark_id, name))
+        end_anchor.ends.append(bookmark_id)
+
+    def flushBookmarks(self):
+        # bookmarks are written along with the paragraphs
+        return len(self.bookmarks)
+
+    def insertHyperlink(self, text, target, internal=False):
+        if internal or target.startswith("_"):
+            link = Hyperlink(text, "", target, self.font)
+        else:
+            link = Hyperlink(text, target, "", self.font)
+        self.paragraph.items.append(link)
+
+    def getCurrentPosition(self):
+        """
+        Positions are opaque: a zero-width anchor is dropped at the cursor
+        and its id is returned (ids start at 1 so that they are never false).
+        """
+        anchor = Anchor(self._nextId())
+        self.anchors[anchor.id] = anchor
+        self.paragraph.items.append(anchor)
+        return anchor.id
+
+    def clearFormatting(self):
+        self._setParagraphStyle(None)
+        self.paragraph.align = None
+        self.char_style = None
+        self.font = set()
+
+    def backspace(self):
+        """
+        Emulates Selection.TypeBackspace: removes the last paragraph mark when
+        the current paragraph is empty, the last character otherwise.
+        """
+        if self.paragraph.isEmpty():
+            index = self._indexOf(self.paragraph)
+            if index > 0 and isinstance(self.container[index - 1], Paragraph):
+                previous = self.container[index - 1]
+                previous.items.extend(self.paragraph.items)
+                del self.container[index]
+                self.paragraph = previous
+            return
+        for item in reversed(self.paragraph.items):
+            if isinstance(item, Run):
+                item.text = item.text[:-1]
+                return
+            elif not isinstance(item, Anchor):
+                self.paragraph.items.remove(item)
+                return
+
+    def resetListStartNumber(self):
+        style_id = self.paragraph.style
+        num_id = self.template.restartNumbering(style_id, len(self.restarts))
+        if num_id is None:
+            return
+        self.restarts.append((style_id, num_id))
+        self.numbering[style_id] = num_id
+        self.paragraph.num_id = num_id
+
+    def _nextId(self):
+        self.next_id += 1
+        return self.next_id - 1
+
+    def _newParagraph(self, style, align):
+        paragraph = Paragraph(style, align)
+        paragraph.num_id = self.numbering.get(style)
+        if self.paragraph is None or self.container[-1] is self.paragraph:
+            self.container.append(paragraph)
+        else:
+            self.container.insert(self._indexOf(self.paragraph) + 1, paragraph)
+        self.paragraph = paragraph
+
+    def _indexOf(self, block):
+        # the cursor is almost always on the last block of its container
+        if self.container[-1] is block:
+            return len(self.container) - 1
+        return self.container.index(block)
+
+    def _setParagraphStyle(self, style_id):
+        self.paragraph.style = style_id
+        self.paragraph.num_id = self.numbering.get(style_id)
+
+    def _enterCell(self, table, row, col):
+        # the character formatting comes from where the cursor lands
+        table.row, table.col = row, col
+        self.container = table.cell
+        self.paragraph = self.container[-1]
+        self.char_style = None
+        self.font = set()
+
+
+
+#################################################################
+#### DOCUMENT MODEL #############################################
+#################################################################
+
+class Paragraph:
+
+    def __init__(self, style=None, align=None):
+        self.style = style
+        self.align = align
+        self.num_id = None
+        self.items = []
+
+    def isEmpty(self):
+        for item in self.items:
+            if not isinstance(item, Anchor):
+                return False
+        return True
+
+    def toXml(self, package):
+        xml = [u"<w:p>"]
+        props = []
+        if self.style:
+            props.append(u'<w:pStyle w:val=%s/>' % quoteattr(self.style))
+        if self.num_id is not None:
+            props.append(u'<w:numPr><w:numId w:val="%d"/></w:numPr>' % self.num_id)
+        if self.align:
+            props.append(u'<w:jc w:val="%s"/>' % self.align)
+        if props:
+            xml.append(u"<w:pPr>%s</w:pPr>" % u"".join(props))
+        for item in self.items:
+            xml.append(item.toXml(package))
+        xml.append(u"</w:p>")
+        return u"".join(xml)
+
+
+class Table:
+
+    def __init__(self, rows, cols, style=None, align=None):
+        self.rows = rows
+        self.cols = cols
+        self.cells = [[[Paragraph(style, align)] for _ in range(cols)] for _ in range(rows)]
+        self.row = 0
+        self.col = 0
+        self.style = None
+        self.padding = None
+        self.border = False
+        self.heading = False
+        self.header_color = None
+        self.widths = None
+        self.fit = CST.wdAutoFitContent
+        self.align = "center"
+        self.outer = None
+        self.after = None
+
+    @property
+    def cell(self):
+        return self.cells[self.row][self.col]
+
+    def toXml(self, package):
+        xml = [u"<w:tbl><w:tblPr>"]
+        if self.style:
+            xml.append(u'<w:tblStyle w:val=%s/>' % quoteattr(self.style))
+        if self.fit == CST.wdAutoFitWindow:
+            xml.append(u'<w:tblW w:w="5000" w:type="pct"/>')
+        else:
+            xml.append(u'<w:tblW w:w="0" w:type="auto"/>')
+        if self.align:
+            xml.append(u'<w:jc w:val="%s"/>' % self.align)
+        if self.border:
+            xml.append(u"<w:tblBorders>")
+            for side in ("top", "left", "bottom", "right", "insideH", "insideV"):
+                xml.append(u'<w:%s w:val="single" w:sz="4" w:space="0" w:color="auto"/>' % side)
+            xml.append(u"</w:tblBorders>")
+        if self.fit == CST.wdAutoFitFixed:
+            xml.append(u'<w:tblLayout w:type="fixed"/>')
+        if self.padding:
+            vertical, lateral = self.padding
+            xml.append(u'<w:tblCellMar><w:top w:w="%d" w:type="dxa"/><w:left w:w="%d" w:type="dxa"/>'
+                       u'<w:bottom w:w="%d" w:type="dxa"/><w:right w:w="%d" w:type="dxa"/></w:tblCellMar>'
+                       % (vertical, lateral, vertical, lateral))
+        if self.style:
+            # same conditional formatting as the tables styled by Word
+            xml.append(u'<w:tblLook w:val="04A0"/>')
+        xml.append(u"</w:tblPr><w:tblGrid>")
+        widths = self.widths or [package.template.text_width // max(self.cols, 1)] * self.cols
+        for width in widths:
+            xml.append(u'<w:gridCol w:w="%d"/>' % width)
+        xml.append(u"</w:tblGrid>")
+        for r, row in enumerate(self.cells):
+            xml.append(u"<w:tr>")
+            if r == 0 and self.heading:
+                xml.append(u"<w:trPr><w:cantSplit/><w:tblHeader/></w:trPr>")
+            elif self.heading:
+                xml.append(u"<w:trPr><w:cantSplit/></w:trPr>")
+            for c, cell in enumerate(row):
+                xml.append(u"<w:tc><w:tcPr>")
+                if self.fit == CST.wdAutoFitFixed or self.widths:
+                    xml.append(u'<w:tcW w:w="%d" w:type="dxa"/>' % widths[c])
+                else:
+                    xml.append(u'<w:tcW w:w="0" w:type="auto"/>')
+                if r == 0 and self.header_color:
+                    xml.append(u'<w:shd w:val="clear" w:color="auto" w:fill="%s"/>' % self.header_color)
+                xml.append(u"</w:tcPr>")
+                xml.append(blocksToXml(cell, package))
+                xml.append(u"</w:tc>")
+            xml.append(u"</w:tr>")
+        xml.append(u"</w:tbl>")
+        return u"".join(xml)
+
+
+class Run:
+
+    def __init__(self, text, style=None, font=()):
+        self.text = text
+        self.style = style
+        self.font = frozenset(font)
+
+    def hasFormat(self, style, font):
+        return self.style == style and self.font == font
+
+    def toXml(self, package):
+        xml = [u"<w:r>", runProperties(self.style, self.font)]
+        lines = NEWLINE_REX.split(ILLEGAL_XML_REX.sub(u"", self.text))
+        for i, line in enumerate(lines):
+            if i > 0:
+                xml.append(u"<w:br/>")
+            chunks = line.split(u"\t")
+            for j, chunk in enumerate(chunks):
+                if j > 0:
+                    xml.append(u"<w:tab/>")
+                if chunk:
+                    xml.append(u'<w:t xml:space="preserve">%s</w:t>' % escape(chunk))
+        xml.append(u"</w:r>")
+        return u"".join(xml)
+
+
+class Break:
+
+    def __init__(self, type=None):
+        self.type = type
+
+    def toXml(self, package):
+        if self.type:
+            return u'<w:r><w:br w:type="%s"/></w:r>' % self.type
+        return u"<w:r><w:br/></w:r>"
+
+
+class Anchor:
+
+    def __init__(self, id):
+        self.id = id
+        self.starts = []
+        self.ends = []
+
+    def toXml(self, package):
+        xml = []
+        for bookmark_id, name in self.starts:
+            xml.append(u'<w:bookmarkStart w:id="%d" w:name=%s/>' % (bookmark_id, quoteattr(name)))
+        for bookmark_id in self.ends:
+            xml.append(u'<w:bookmarkEnd w:id="%d"/>' % bookmark_id)
+        return u"".join(xml)
+
+
+class Hyperlink:
+    """
+    Attribute names match the COM Hyperlink object so that the translator
+    can handle both backends the same way.
+    """
+
+    def __init__(self, text, address, sub_address, font=()):
+        self.TextToDisplay = text
+        self.Address = address
+        self.SubAddress = sub_address
+        self.font = frozenset(font)
+
+    def toXml(self, package):
+        run = Run(self.TextToDisplay, package.template.hyperlink_style, self.font).toXml(package)
+        if self.SubAddress:
+            return u'<w:hyperlink w:anchor=%s w:history="1">%s</w:hyperlink>' % (quoteattr(self.SubAddress), run)
+        rel_id = package.addRelationship("hyperlink", self.Address, external=True)
+        return u'<w:hyperlink r:id="%s" w:history="1">%s</w:hyperlink>' % (rel_id, run)
+
+
+class InlineImage:
+
+    def __init__(self, path, id, width, height):
+        self.path = path
+        self.id = id
+        self.Width = width
+        self.Height = height
+        self.LockAspectRatio = -1
+
+    def toXml(self, package):
+        rel_id = package.addImage(self.path)
+        cx = int(self.Width * EMU_PER_POINT)
+        cy = int(self.Height * EMU_PER_POINT)
+        name = quoteattr(os.path.basename(self.path))
+        return (u'<w:r><w:drawing><wp:inline distT="0" distB="0" distL="0" distR="0">'
+                u'<wp:extent cx="%(cx)d" cy="%(cy)d"/><wp:docPr id="%(id)d" name=%(name)s/>'
+                u'<wp:cNvGraphicFramePr><a:graphicFrameLocks xmlns:a="%(a)s" noChangeAspect="1"/></wp:cNvGraphicFramePr>'
+                u'<a:graphic xmlns:a="%(a)s"><a:graphicData uri="%(pic)s"><pic:pic xmlns:pic="%(pic)s">'
+                u'<pic:nvPicPr><pic:cNvPr id="0" name=%(name)s/><pic:cNvPicPr/></pic:nvPicPr>'
+                u'<pic:blipFill><a:blip r:embed="%(rel)s"/><a:stretch><a:fillRect/></a:stretch></pic:blipFill>'
+                u'<pic:spPr><a:xfrm><a:off x="0" y="0"/><a:ext cx="%(cx)d" cy="%(cy)d"/></a:xfrm>'
+                u'<a:prstGeom prst="rect"><a:avLst/></a:prstGeom></pic:spPr></pic:pic></a:graphicData></a:graphic>'
+                u'</wp:inline></w:drawing></w:r>'
+                % {"cx": cx, "cy": cy, "id": self.id, "name": name, "rel": rel_id, "a": A_NS, "pic": PIC_NS})
+
+
+class PropertyField:
+
+    def __init__(self, name, style=None, font=()):
+        self.name = name
+        self.style = style
+        self.font = frozenset(font)
+
+    def toXml(self, package):
+        value = package.docx.getDocProperty(self.name)
+        run = Run(value, self.style, self.font).toXml(package)
+        return u'<w:fldSimple w:instr=%s>%s</w:fldSimple>' % (quoteattr(u" DOCPROPERTY  %s " % self.name), run)
+
+
+class SequenceField:
+
+    def __init__(self, label):
+        self.label = label
+
+    def toXml(self, package):
+        return u'<w:fldSimple w:instr=%s><w:r><w:t>1</w:t></w:r></w:fldSimple>' % \
+            quoteattr(u" SEQ %s \\* ARABIC " % self.label)
+
+
+class TocField:
+
+    def __init__(self, depth=3):
+        self.depth = depth
+
+    def toXml(self, package):
+        return (u'<w:r><w:fldChar w:fldCharType="begin" w:dirty="true"/></w:r>'
+                u'<w:r><w:instrText xml:space="preserve"> TOC \\o "1-%d" \\h \\z \\u </w:instrText></w:r>'
+                u'<w:r><w:fldChar w:fldCharType="separate"/></w:r>'
+                u'<w:r><w:t>Update this field to generate the table of contents.</w:t></w:r>'
+                u'<w:r><w:fldChar w:fldCharType="end"/></w:r>' % self.depth)
+
+
+def setBold(blocks):
+    for block in walkBlocks(blocks):
+        if isinstance(block, Paragraph):
+            for item in block.items:
+                if hasattr(item, "font"):
+                    item.font = item.font | frozenset(["Bold"])
+
+def runProperties(style, font):
+    props = []
+    if style:
+        props.append(u'<w:rStyle w:val=%s/>' % quoteattr(style))
+    if "Bold" in font:
+        props.append(u"<w:b/>")
+    if "Italic" in font:
+        props.append(u"<w:i/>")
+    if "Superscript" in font:
+        props.append(u'<w:vertAlign w:val="superscript"/>')
+    elif "Subscript" in font:
+        props.append(u'<w:vertAlign w:val="subscript"/>')
+    if props:
+        return u"<w:rPr>%s</w:rPr>" % u"".join(props)
+    return u""
+
+def blocksToXml(blocks, package):
+    return u"".join(b.toXml(package) for b in blocks)
+
+def walkBlocks(blocks):
+    for b in blocks:
+        yield b
+        if isinstance(b, Table):
+            for row in b.cells:
+                for cell in row:
+                    for bb in walkBlocks(cell):
+                        yield bb
+
+
+
+#################################################################
+#### TEMPLATE & PACKAGE #########################################
+#################################################################
+
+class Style:
+
+    def __init__(self, id, name, type, default=False, next=None, based_on=None, num_id=None):
+        self.id = id
+        self.name = name
+        self.type = type
+        self.default = default
+        self.next = next
+        self.based_on = based_on
+        self.num_id = num_id
+
+
+class Template:
+    """
+    Parts of the .dotx file and what we need to know about them.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.parts = {}
+        z = zipfile.ZipFile(filename)
+        try:
+            for info in z.infolist():
+                self.parts[info.filename] = z.read(info.filename)
+        finally:
+            z.close()
+
+        self.styles = {}
+        self.styles_by_name = {}
+        self._parseStyles()
+        self.hyperlink_style = self.getStyleId("hyperlink")
+
+        self.nums = {}
+        self.lvl_styles = {}
+        self._parseNumbering()
+
+        document = self.parts["word/document.xml"].decode("utf-8")
+        body_start = document.index("<w:body>") + len("<w:body>")
+        body_end = document.rindex("</w:body>")
+        self.root_tag = document[document.index("<w:document"):document.index(">", document.index("<w:document")) + 1]
+        body = document[body_start:body_end]
+        sect_index = body.rfind("<w:sectPr")
+        if sect_index >= 0:
+            self.body, self.sect_pr = body[:sect_index], body[sect_index:]
+        else:
+            self.body, self.sect_pr = body, u""
+        self.text_width = self._textWidth()
+
+    def getStyle(self, style):
+        if isinstance(style, int):
+            style = BUILTIN_STYLE_NAMES.get(style)
+            if style is None:
+                return None
+        return self.styles_by_name.get(style.lower()) or self.styles.get(style)
+
+    def getStyleId(self, style):
+        s = self.getStyle(style)
+        if s is None:
+            return None
+        return s.id
+
+    def restartNumbering(self, style_id, index):
+        """
+        Returns the id of a new w:num restarting the list linked to the
+        given paragraph style. Num elements are added when the package is
+        written (see Package.numberingXml).
+        """
+        style = self.styles.get(style_id)
+        while style is not None and style.num_id is None:
+            style = self.styles.get(style.based_on)
+        if style is None or style.num_id not in self.nums:
+            return None
+        return self.max_num_id + index + 1
+
+    def numOverride(self, style_id, num_id):
+        style = self.styles.get(style_id)
+        while style.num_id is None:
+            style = self.styles.get(style.based_on)
+        abstract = self.nums[style.num_id]
+        level = self.lvl_styles.get((abstract, style_id), 0)
+        return (u'<w:num w:numId="%d"><w:abstractNumId w:val="%s"/><w:lvlOverride w:ilvl="%d">'
+                u'<w:startOverride w:val="1"/></w:lvlOverride></w:num>' % (num_id, abstract, level))
+
+    def _parseStyles(self):
+        root = ElementTree.fromstring(self.parts["word/styles.xml"])
+        for node in root.findall(w("style")):
+            name = node.find(w("name"))
+            next = node.find(w("next"))
+            based_on = node.find(w("basedOn"))
+            num_id = node.find("%s/%s/%s" % (w("pPr"), w("numPr"), w("numId")))
+            style = Style(id=node.get(w("styleId")),
+                          name=name is not None and name.get(w("val")) or node.get(w("styleId")),
+                          type=node.get(w("type")),
+                          default=node.get(w("default")) in ("1", "true", "on"),
+                          next=next is not None and next.get(w("val")) or None,
+                          based_on=based_on is not None and based_on.get(w("val")) or None,
+                          num_id=num_id is not None and num_id.get(w("val")) or None)
+            self.styles[style.id] = style
+            self.styles_by_name[style.name.lower()] = style
+
+    def _parseNumbering(self):
+        self.max_num_id = 0
+        if "word/numbering.xml" not in self.parts:
+            return
+        root = ElementTree.fromstring(self.parts["word/numbering.xml"])
+        for node in root.findall(w("abstractNum")):
+            abstract_id = node.get(w("abstractNumId"))
+            for lvl in node.findall(w("lvl")):
+                pstyle = lvl.find(w("pStyle"))
+                if pstyle is not None:
+                    self.lvl_styles[(abstract_id, pstyle.get(w("val")))] = int(lvl.get(w("ilvl")))
+        for node in root.findall(w("num")):
+            num_id = node.get(w("numId"))
+            self.nums[num_id] = node.find(w("abstractNumId")).get(w("val"))
+            self.max_num_id = max(self.max_num_id, int(num_id))
+
+    def _textWidth(self):
+        page = re.search(r'<w:pgSz [^>]*w:w="(\d+)"', self.sect_pr)
+        left = re.search(r'<w:pgMar [^>]*w:left="(\d+)"', self.sect_pr)
+        right = re.search(r'<w:pgMar [^>]*w:right="(\d+)"', self.sect_pr)
+        if page and left and right:
+            return int(page.group(1)) - int(left.group(1)) - int(right.group(1))
+        return 9000
+
+
+class Package:
+    """
+    Writes a .docx file from a Docx document and its template.
+    """
+
+    def __init__(self, docx, template):
+        self.docx = docx
+        self.template = template
+        self.relationships = []
+        self.media = {}
+
+    def addRelationship(self, type, target, external=False):
+        rel_id = "rst2word%d" % (len(self.relationships) + 1)
+        self.relationships.append((rel_id, REL_TYPE + type, target, external))
+        return rel_id
+
+    def addImage(self, path):
+        if path not in self.media:
+            self.media[path] = self.addRelationship("image", self.docx.images[path])
+        return self.media[path]
+
+    def write(self, filename):
+        parts = dict(self.template.parts)
+        parts["word/document.xml"] = self.documentXml().encode("utf-8")
+        parts["word/_rels/document.xml.rels"] = self.documentRelsXml(parts["word/_rels/document.xml.rels"])
+        parts["[Content_Types].xml"] = self.contentTypesXml(parts["[Content_Types].xml"])
+        if self.docx.restarts:
+            parts["word/numbering.xml"] = self.numberingXml(parts["word/numbering.xml"])
+        if self.docx.update_fields:
+            parts["word/settings.xml"] = self.settingsXml(parts["word/settings.xml"])
+        self.writeProperties(parts)
+
+        z = zipfile.ZipFile(filename, "w", zipfile.ZIP_DEFLATED)
+        try:
+            # the content types part must come first
+            z.writestr("[Content_Types].xml", parts.pop("[Content_Types].xml"))
+            for name in sorted(parts):
+                z.writestr(name, parts[name])
+            for path, part in sorted(self.docx.images.items()):
+                z.write(path, "word/" + part, zipfile.ZIP_STORED)
+        finally:
+            z.close()
+
+    def documentXml(self):
+        root_tag = self.template.root_tag
+        for prefix, ns in (("w", W_NS), ("r", R_NS), ("wp", WP_NS)):
+            if "xmlns:%s=" % prefix not in root_tag:
+                root_tag = root_tag[:-1] + ' xmlns:%s="%s">' % (prefix, ns)
+        return u"".join([u'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n',
+                         root_tag, u"<w:body>",
+                         blocksToXml(self.docx.body, self),
+                         self.template.body,
+                         self.template.sect_pr,
+                         u"</w:body></w:document>"])
+
+    def documentRelsXml(self, rels):
+        xml = []
+        for rel_id, type, target, external in self.relationships:
+            mode = external and ' TargetMode="External"' or ""
+            xml.append(u'<Relationship Id="%s" Type="%s" Target=%s%s/>' % (rel_id, type, quoteattr(target), mode))
+        return insertBefore(rels, "</Relationships>", u"".join(xml))
+
+    def contentTypesXml(self, types):
+        types = types.replace(TEMPLATE_MAIN_TYPE, DOCUMENT_MAIN_TYPE)
+        extensions = set(os.path.splitext(p)[1][1:] for p in self.docx.images.values())
+        for ext in sorted(extensions):
+            if ('Extension="%s"' % ext).encode("utf-8") not in types:
+                types = insertBefore(types, "</Types>", u'<Default Extension="%s" ContentType="%s"/>'
+                                     % (ext, IMAGE_TYPES.get(ext, "application/octet-stream")))
+        if self.customProperties() and b"/docProps/custom.xml" not in types:
+            types = insertBefore(types, "</Types>", u'<Override PartName="/docProps/custom.xml" ContentType="%s"/>'
+                                 % CUSTOM_PROPS_TYPE)
+        return types
+
+    def numberingXml(self, numbering):
+        nums = u"".join(self.template.numOverride(style_id, num_id)
+                        for style_id, num_id in self.docx.restarts)
+        if b"<w:numIdMacAtCleanup" in numbering:
+            return insertBefore(numbering, "<w:numIdMacAtCleanup", nums)
+        return insertBefore(numbering, "</w:numbering>", nums)
+
+    def settingsXml(self, settings):
+        if b"<w:updateFields" in settings:
+            return settings
+        for following in ("<w:hdrShapeDefaults", "<w:footnotePr", "<w:endnotePr", "<w:compat",
+                          "<w:docVars", "<w:rsids", "<m:mathPr", "<w:themeFontLang", "<w:clrSchemeMapping"):
+            if following.encode("utf-8") in settings:
+                return insertBefore(settings, following, u'<w:updateFields w:val="true"/>')
+        return insertBefore(settings, "</w:settings>", u'<w:updateFields w:val="true"/>')
+
+    def customProperties(self):
+        return sorted((k, v) for k, v in self.docx.properties.items() if k not in BUILTIN_PROPERTIES)
+
+    def writeProperties(self, parts):
+        props = self.docx.properties
+        now = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        core = [u'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                u'<cp:coreProperties xmlns:cp="http://schemas.openxmlformats.org/package/2006/metadata/core-properties" '
+                u'xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:dcterms="http://purl.org/dc/terms/" '
+                u'xmlns:dcmitype="http://purl.org/dc/dcmitype/" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">']
+        for name in ("Title", "Subject", "Author", "Comments", "Revision number"):
+            if name in props:
+                tag = BUILTIN_PROPERTIES[name]
+                core.append(u"<%s>%s</%s>" % (tag, escape(props[name]), tag))
+        core.append(u'<dcterms:created xsi:type="dcterms:W3CDTF">%s</dcterms:created>'
+                    u'<dcterms:modified xsi:type="dcterms:W3CDTF">%s</dcterms:modified>'
+                    u'</cp:coreProperties>' % (now, now))
+        parts["docProps/core.xml"] = u"".join(core).encode("utf-8")
+
+        if "Company" in props and "docProps/app.xml" in parts:
+            app = re.sub(b"<Company>.*?</Company>|<Company/>", b"", parts["docProps/app.xml"])
+            parts["docProps/app.xml"] = insertBefore(app, "</Properties>",
+                                                     u"<Company>%s</Company>" % escape(props["Company"]))
+
+        custom = self.customProperties()
+        if custom:
+            xml = [u'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                   u'<Properties xmlns="http://schemas.openxmlformats.org/officeDocument/2006/custom-properties" '
+                   u'xmlns:vt="http://schemas.openxmlformats.org/officeDocument/2006/docPropsVTypes">']
+            for pid, (name, value) in enumerate(custom):
+                xml.append(u'<property fmtid="{D5CDD505-2E9C-101B-9397-08002B2CF9AE}" pid="%d" name=%s>'
+                           u'<vt:lpwstr>%s</vt:lpwstr></property>' % (pid + 2, quoteattr(name), escape(value)))
+            xml.append(u"</Properties>")
+            parts["docProps/custom.xml"] = u"".join(xml).encode("utf-8")
+            if b"docProps/custom.xml" not in parts["_rels/.rels"]:
+                parts["_rels/.rels"] = insertBefore(parts["_rels/.rels"], "</Relationships>",
+                    u'<Relationship Id="rst2wordCustom" Type="%scustom-properties" Target="docProps/custom.xml"/>'
+                    % REL_TYPE)
+
+
+
+#################################################################
+#### UTIL METHODS ###############################################
+#################################################################
+
+def w(tag):
+    return "{%s}%s" % (W_NS, tag)
+
+def insertBefore(xml, marker, text):
+    marker = marker.encode("utf-8")
+    index = xml.rindex(marker)
+    return xml[:index] + text.encode("utf-8") + xml[index:]
+
+def CentimetersToTwips(centimeters):
+    return int(centimeters * 567)
+
+def wordColorToHex(color):
+    # word colors are BGR integers
+    return "%02X%02X%02X" % (color & 0xFF, (color >> 8) & 0xFF, (color >> 16) & 0xFF)
@@ -0,0 +1,152 @@
+'''
+This file is part of rst2word
+
+Keeps the top-level sections of documents generated by parts (see
+batch.generateParts) between runs, so that only the sections that changed
+are generated again. A section is stored under the checksum of everything
+its output depends on: its doctree, the bookmark names it creates or links
+to, the template, the settings of the writer and the content of the files
+it includes (images, raw files).
+
+@author: Robin Jarry
+'''
+from docutils import nodes
+from rst2wordlib.visitor import ILLEGAL_REX
+import hashlib, json, os.path, shutil, sys
+
+# settings of the writer that do not change the generated document
+PROCESS_SETTINGS = set(["show_gui", "headless", "image_cache", "excel_recycle",
+                        "word_pool", "word_recycle", "word_max_memory",
+                        "split_jobs", "section_cache"])
+
+# path -> (mtime, size, checksum)
+_checksums = {}
+
+class SectionCache:
+    """
+    Directory of generated sections: <key>.docx with the document properties
+    and the kinds of fields of the section in <key>.json.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.stats = {"section cache hits": 0, "section cache misses": 0}
+
+    def get(self, key):
+        """
+        Returns the (path, properties, fields) of a section, None if it is
+        not in the cache.
+        """
+        path = os.path.join(self.directory, key + ".docx")
+        meta = os.path.join(self.directory, key + ".json")
+        if not (os.path.exists(path) and os.path.exists(meta)):
+            self.stats["section cache misses"] += 1
+            return None
+        f = open(meta, "r")
+        try:
+            data = json.load(f)
+        finally:
+            f.close()
+        self.stats["section cache hits"] += 1
+        return path, data["properties"], set(data["fields"])
+
+    def put(self, key, filename, properties, fields):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, key + ".docx")
+        meta = os.path.join(self.directory, key + ".json")
+        # written under other names first, other runs may read the cache
+        # the metadata comes last: get ignores a section without it
+        temp = "%s.%d.tmp" % (path, os.getpid())
+        shutil.copyfile(filename, temp)
+        replace(temp, path)
+        temp = "%s.%d.tmp" % (meta, os.getpid())
+        f = open(temp, "w")
+        try:
+            json.dump({"properties": properties, "fields": sorted(fields)}, f)
+        finally:
+            f.close()
+        replace(temp, meta)
+
+
+def sectionKey(children, bookmarks, sections, settings, spec, root_path):
+    """
+    Returns the checksum of what the output of a part of a document depends
+    on. bookmarks and sections are the bookmark names of the document (see
+    visitor.index_bookmarks), spec is the settings_spec of the writer.
+    """
+    digest = hashlib.sha1()
+    for name in sorted(writerSettings(spec)):
+        if name not in PROCESS_SETTINGS:
+            digest.update("%s=%r\n" % (name, getattr(settings, name, None)))
+    digest.update("input_encoding=%r\n" % settings.input_encoding)
+    if settings.word_template:
+        digest.update("template=%s\n" % fileChecksum(settings.word_template))
+    for child in children:
+        digest.update(child.pformat().encode("utf-8"))
+        for node in child.traverse():
+            if not isinstance(node, nodes.Element):
+                continue
+            # the names depend on the rest of the document
+            for id in node["ids"] + [node.get("refid")]:
+                if not id:
+                    continue
+                bookmark_id = ILLEGAL_REX.subn("_", id)[0]
+                if bookmark_id in bookmarks:
+                    line = u"bookmark %s=%s\n" % (bookmark_id, bookmarks[bookmark_id])
+                    digest.update(line.encode("utf-8"))
+            if isinstance(node, nodes.section) and node["ids"] and node["ids"][0] in sections:
+                line = u"section %s=%s\n" % (node["ids"][0], sections[node["ids"][0]])
+                digest.update(line.encode("utf-8"))
+            if isinstance(node, nodes.image):
+                path = node["uri"]
+            elif isinstance(node, nodes.raw) and node.get("source"):
+                path = node["source"]
+            else:
+                continue
+            path = os.path.normpath(os.path.join(bytesPath(root_path), bytesPath(path)))
+            if os.path.exists(path):
+                digest.update("file %s=%s\n" % (path, fileChecksum(path)))
+    return digest.hexdigest()
+
+def writerSettings(spec):
+    """
+    Returns the names of the settings of a settings_spec.
+    """
+    names = []
+    for i in range(0, len(spec), 3):
+        for _, option_strings, kwargs in spec[i + 2]:
+            names.append(kwargs.get("dest") or option_strings[0].lstrip("-").replace("-", "_"))
+    return names
+
+def bytesPath(path):
+    # hashed as the bytes of the file system, whatever they are
+    if isinstance(path, unicode):
+        return path.encode(sys.getfilesystemencoding() or "utf-8")
+    return path
+
+def fileChecksum(path):
+    stat = os.stat(path)
+    cached = _checksums.get(path)
+    if cached is not None and cached[:2] == (stat.st_mtime, stat.st_size):
+        return cached[2]
+    digest = hashlib.sha1()
+    f = open(path, "rb")
+    try:
+        while True:
+            data = f.read(64 * 1024)
+            if not data:
+                break
+            digest.update(data)
+    finally:
+        f.close()
+    _checksums[path] = (stat.st_mtime, stat.st_size, digest.hexdigest())
+    return digest.hexdigest()
+
+def replace(temp, target):
+    try:
+        os.rename(temp, target)
+    except OSError:
+        # windows does not replace files
+        os.remove(target)
+        os.rename(temp, target)
@@ -0,0 +1,350 @@
+'''
+This file is part of rst2word
+
+Reads the cells of .xlsx workbooks and of SpreadsheetML 2003 (XML Excel)
+files without Excel. The sheets are parsed incrementally, so that large
+ones are not loaded as a whole: only the texts of their cells are kept.
+Legacy binary (BIFF) workbooks are left to Excel (see wrapper.ExcelPool).
+
+@author: Robin Jarry
+'''
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+import datetime, posixpath, re, zipfile
+
+SPREADSHEET_NS = "{urn:schemas-microsoft-com:office:spreadsheet}"
+EXCEL_NS = "{urn:schemas-microsoft-com:office:excel}"
+RELATIONSHIP_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+
+CELL_REX = re.compile(r"^\$?([A-Za-z]+)\$?(\d+)$")
+# number formats of dates and times once their literal parts are removed
+DATE_FORMAT_REX = re.compile(r"[dmyhs]", re.I)
+FORMAT_LITERAL_REX = re.compile(r'"[^"]*"|\[[^\]]*\]|\\.')
+# built-in number formats of dates and times
+DATE_FORMAT_IDS = set(range(14, 23) + range(45, 48))
+
+EXCEL_EPOCH = datetime.datetime(1899, 12, 30)
+EXCEL_EPOCH_1904 = datetime.datetime(1904, 1, 1)
+
+def readCells(path, sheet=None, cells=None):
+    """
+    Returns the texts of the cells of a sheet (name or number, the active
+    one by default), rows of the used range or of the given range
+    ("A1:D20"). Returns None if the format of the file is not supported.
+    """
+    f = open(path, "rb")
+    try:
+        head = f.read(1024)
+    finally:
+        f.close()
+    bounds = cells and parseRange(cells) or None
+    if head[:4] == b"PK\x03\x04":
+        package = zipfile.ZipFile(path)
+        try:
+            if "xl/workbook.xml" not in package.namelist():
+                # .xlsb, or not a workbook at all
+                return None
+            return buildRows(readXlsxRows(package, sheet), bounds)
+        finally:
+            package.close()
+    elif b"urn:schemas-microsoft-com:office:spreadsheet" in head:
+        return buildRows(readSpreadsheetMLRows(path, sheet), bounds)
+    return None
+
+def cellText(value):
+    """
+    Text of the value of a spreadsheet cell: numbers are floats, dates are
+    datetimes or pywintypes times when they come from Excel.
+    """
+    if value is None:
+        return u""
+    if isinstance(value, float):
+        if value == int(value):
+            return unicode(int(value))
+        return unicode(repr(value))
+    if isinstance(value, datetime.datetime):
+        if value.time() == datetime.time():
+            return unicode(value.strftime("%Y-%m-%d"))
+        return unicode(value.strftime("%Y-%m-%d %H:%M:%S"))
+    if hasattr(value, "Format"):
+        return unicode(value.Format("%Y-%m-%d"))
+    # tabs and paragraph marks would split the cell (see Word.beginTable)
+    return u" ".join(unicode(value).split())
+
+
+
+#################################################################
+#### XLSX #######################################################
+#################################################################
+
+def readXlsxRows(package, sheet):
+    """
+    Yields (row number, [(column number, text)]) for the non empty rows of
+    a sheet of an .xlsx package.
+    """
+    sheets, active, date1904 = readWorkbook(package)
+    names = [name for name, _ in sheets]
+    if sheet is None:
+        index = min(active, len(sheets) - 1)
+    elif sheet.isdigit():
+        index = int(sheet) - 1
+    elif sheet in names:
+        index = names.index(sheet)
+    else:
+        index = -1
+    if not 0 <= index < len(sheets):
+        raise ValueError("The workbook has no sheet %s" % sheet)
+    part = sheets[index][1]
+    strings = readSharedStrings(package)
+    date_styles = readDateStyles(package)
+    epoch = date1904 and EXCEL_EPOCH_1904 or EXCEL_EPOCH
+
+    number = 0
+    for _, elem in ElementTree.iterparse(package.open(part)):
+        if localName(elem.tag) != "row":
+            continue
+        number = int(elem.get("r") or number + 1)
+        row = []
+        column = 0
+        for c in elem:
+            if localName(c.tag) != "c":
+                continue
+            ref = c.get("r")
+            if ref:
+                column = columnNumber(CELL_REX.match(ref).group(1))
+            else:
+                column += 1
+            text = xlsxCellText(c, strings, date_styles, epoch)
+            if text:
+                row.append((column, text))
+        if row:
+            yield number, row
+        elem.clear()
+
+def xlsxCellText(c, strings, date_styles, epoch):
+    type = c.get("t", "n")
+    value = None
+    for child in c:
+        name = localName(child.tag)
+        if name == "v":
+            value = child.text
+        elif name == "is":
+            return cellText(richText(child))
+    if value is None:
+        return u""
+    if type == "s":
+        return strings[int(value)]
+    if type == "b":
+        return value == "1" and u"TRUE" or u"FALSE"
+    if type in ("str", "e", "d"):
+        return cellText(value)
+    number = float(value)
+    if int(c.get("s", 0)) in date_styles:
+        return cellText(epoch + datetime.timedelta(days=number))
+    return cellText(number)
+
+def readWorkbook(package):
+    """
+    Returns the (name, part) of the sheets of a workbook, the index of the
+    active one and whether dates are counted from 1904.
+    """
+    targets = {}
+    rels = ElementTree.parse(package.open("xl/_rels/workbook.xml.rels"))
+    for rel in rels.getroot():
+        target = rel.get("Target")
+        if target.startswith("/"):
+            target = target[1:]
+        else:
+            target = posixpath.normpath(posixpath.join("xl", target))
+        targets[rel.get("Id")] = target
+    sheets = []
+    active = 0
+    date1904 = False
+    for elem in ElementTree.parse(package.open("xl/workbook.xml")).getroot().iter():
+        name = localName(elem.tag)
+        if name == "sheet":
+            sheets.append((elem.get("name"), targets[elem.get(RELATIONSHIP_NS + "id")]))
+        elif name == "workbookView":
+            active = int(elem.get("activeTab", 0))
+        elif name == "workbookPr":
+            date1904 = elem.get("date1904") in ("1", "true")
+    return sheets, active, date1904
+
+def readSharedStrings(package):
+    strings = []
+    if "xl/sharedStrings.xml" not in package.namelist():
+        return strings
+    for _, elem in ElementTree.iterparse(package.open("xl/sharedStrings.xml")):
+        if localName(elem.tag) == "si":
+            strings.append(cellText(richText(elem)))
+            elem.clear()
+    return strings
+
+def readDateStyles(package):
+    """
+    Returns the indexes of the cell formats that display dates.
+    """
+    styles = set()
+    if "xl/styles.xml" not in package.namelist():
+        return styles
+    root = ElementTree.parse(package.open("xl/styles.xml")).getroot()
+    date_formats = set(DATE_FORMAT_IDS)
+    for elem in root.iter():
+        if localName(elem.tag) == "numFmt":
+            code = FORMAT_LITERAL_REX.sub("", elem.get("formatCode", ""))
+            if DATE_FORMAT_REX.search(code):
+                date_formats.add(int(elem.get("numFmtId")))
+    for elem in root:
+        if localName(elem.tag) == "cellXfs":
+            for i, xf in enumerate(elem):
+                if int(xf.get("numFmtId", 0)) in date_formats:
+                    styles.add(i)
+    return styles
+
+def richText(elem):
+    """
+    Text of a string item, without its phonetic runs.
+    """
+    texts = []
+    for child in elem:
+        name = localName(child.tag)
+        if name == "t":
+            texts.append(child.text or u"")
+        elif name == "r":
+            for t in child:
+                if localName(t.tag) == "t":
+                    texts.append(t.text or u"")
+    return u"".join(texts)
+
+
+
+#################################################################
+#### SPREADSHEETML 2003 #########################################
+#################################################################
+
+def readSpreadsheetMLRows(path, sheet):
+    """
+    Yields (row number, [(column number, text)]) for the non empty rows of
+    a worksheet of a SpreadsheetML 2003 file.
+    """
+    active = 0
+    index = -1
+    selected = found = False
+    number = 0
+    for event, elem in ElementTree.iterparse(path, events=("start", "end")):
+        tag = elem.tag
+        if event == "start":
+            if tag == SPREADSHEET_NS + "Worksheet":
+                index += 1
+                if sheet is None:
+                    selected = index == active
+                elif sheet.isdigit():
+                    selected = index == int(sheet) - 1
+                else:
+                    selected = elem.get(SPREADSHEET_NS + "Name") == sheet
+                found = found or selected
+                number = 0
+            continue
+        if tag == EXCEL_NS + "ActiveSheet":
+            # the workbook options come before the worksheets
+            active = int(elem.text)
+        elif tag == SPREADSHEET_NS + "Row" and selected:
+            number = int(elem.get(SPREADSHEET_NS + "Index") or number + 1)
+            row = []
+            column = 0
+            for cell in elem:
+                if cell.tag != SPREADSHEET_NS + "Cell":
+                    continue
+                column = int(cell.get(SPREADSHEET_NS + "Index") or column + 1)
+                data = cell.find(SPREADSHEET_NS + "Data")
+                if data is not None:
+                    text = spreadsheetMLCellText(data)
+                    if text:
+                        row.append((column, text))
+                column += int(cell.get(SPREADSHEET_NS + "MergeAcross", 0))
+            if row:
+                yield number, row
+            elem.clear()
+        elif tag == SPREADSHEET_NS + "Worksheet":
+            elem.clear()
+            if selected:
+                return
+    if not found:
+        raise ValueError("The workbook has no sheet %s" % (sheet or active + 1))
+
+def spreadsheetMLCellText(data):
+    type = data.get(SPREADSHEET_NS + "Type")
+    # strings can hold HTML formatting elements
+    text = u"".join(data.itertext())
+    if type == "Number":
+        return cellText(float(text))
+    if type == "Boolean":
+        return text.strip() == "1" and u"TRUE" or u"FALSE"
+    if type == "DateTime":
+        return cellText(datetime.datetime.strptime(text[:19], "%Y-%m-%dT%H:%M:%S"))
+    return cellText(text)
+
+
+
+#################################################################
+#### UTIL METHODS ###############################################
+#################################################################
+
+def buildRows(rows, bounds=None):
+    """
+    Returns the texts of the cells of the given rows as a rectangle: the
+    used range (from the first to the last non empty cells) or the
+    (first row, first column, last row, last column) bounds.
+    """
+    if bounds is not None:
+        top, left, bottom, right = bounds
+    else:
+        top = left = bottom = right = None
+    kept = []
+    for number, cells in rows:
+        if bounds is not None:
+            if number < top:
+                continue
+            if number > bottom:
+                break
+            cells = [(column, text) for column, text in cells if left <= column <= right]
+        elif cells:
+            columns = [column for column, _ in cells]
+            if top is None:
+                top, left, right = number, min(columns), max(columns)
+            left = min(left, min(columns))
+            right = max(right, max(columns))
+            bottom = number
+        kept.append((number, cells))
+    if top is None:
+        return []
+    texts = [[u""] * (right - left + 1) for _ in range(bottom - top + 1)]
+    for number, cells in kept:
+        for column, text in cells:
+            texts[number - top][column - left] = text
+    return texts
+
+def parseRange(cells):
+    """
+    Returns the (first row, first column, last row, last column) of a range
+    of cells like "A1:D20".
+    """
+    refs = cells.split(":")
+    first = CELL_REX.match(refs[0].strip())
+    last = CELL_REX.match(refs[-1].strip())
+    if first is None or last is None:
+        raise ValueError("Invalid range of cells: %s" % cells)
+    top, bottom = sorted((int(first.group(2)), int(last.group(2))))
+    left, right = sorted((columnNumber(first.group(1)), columnNumber(last.group(1))))
+    return top, left, bottom, right
+
+def columnNumber(letters):
+    number = 0
+    for letter in letters.upper():
+        number = number * 26 + ord(letter) - ord("A") + 1
+    return number
+
+def localName(tag):
+    return tag.rsplit("}", 1)[-1]
@@ -5,31 +5,42 @@ Created on 26 oct. 2010
 @author: diabeteman
 '''
 from docutils import nodes
-from rst2wordlib.wrapper import Word, Excel
+from rst2wordlib.wrapper import Word, RangeWord, ExcelPool, CentimetersToPoints
+from rst2wordlib.wrapper import readChunks, splitChunks, CHUNK_SIZE
+from rst2wordlib.ooxml import Docx
+from rst2wordlib.spreadsheets import readCells
+from rst2wordlib.images import readImageInfo, ImageResampler, extractThumbnail
 from rst2wordlib.constants import Constants as CST
 from rst2wordlib.constants import getConstant as getCST
-import os.path, re
+import os.path, re, tempfile, time
 
 SPACE_REX = re.compile(r"(\s|\n|\r\n|\r)+", re.DOTALL)
 ILLEGAL_REX = re.compile(r"(\s|-|'|,|\(|\)|\"|:|;|\?|&|#|%|\+|/|\.|!|\*)+")
 
+TABLE_FITS = {"content": CST.wdAutoFitContent, 
+              "fixed": CST.wdAutoFitFixed, 
+              "window": CST.wdAutoFitWindow}
+# average width of a character in a table in points, used to estimate the
+# width of a column from the length of its text
+CHAR_WIDTH = 5.5
+# longer cells wrap anyway
+MAX_CELL_CHARS = 60
+
 
 class WordTranslator(nodes.NodeVisitor):
     
-    def __init__(self, document):
+    def __init__(self, document, word_pool=None):
         nodes.NodeVisitor.__init__(self, document)
         self.settings = document.settings
         if self.settings.word_template and not os.path.isabs(self.settings.word_template):
             self.settings.word_template = os.path.join(os.path.abspath(os.curdir), self.settings.word_template)
         elif not self.settings.word_template:
-            if self.settings._destination.endswith(".docx"):
+            if self.settings._destination.endswith(".docx") or self.settings.backend == "docx":
                 template_extension = ".dotx"
             else:
                 template_extension = ".dot"
             self.settings.word_template = get_default_template(template_extension)
         
-        self.word = Word(self.settings.word_template)
-        
         self.document = document
         self.root_path = os.path.abspath(os.path.dirname(self.document.attributes["source"]))
         self.destination = self.settings._destination
@@ -42,9 +53,24 @@ class WordTranslator(nodes.NodeVisitor):
         else:
             self.pdf_destination = None
         
+        # last, nothing may fail once Word is started
+        if self.settings.backend == "docx":
+            if not self.settings._destination.endswith(".docx"):
+                raise ValueError("The docx backend can only generate .docx files")
+            if self.settings.powerpoint == "ole":
+                raise ValueError("The docx backend cannot embed presentations, use --powerpoint=thumbnail")
+            self.word = Docx(self.settings.word_template)
+        elif self.settings.cursor == "range":
+            self.word = RangeWord(self.settings.word_template, word_pool)
+        else:
+            self.word = Word(self.settings.word_template, word_pool)
+        
         self.section_level = 0
         self.cur_table_dimensions = (0, 0)
         self.in_table = False
+        self.text_table = False
+        self.resampler = None
+        self.excel_pool = None
         self.cur_row = 0
         self.cur_column = 0
         self.list_level = 0
@@ -57,6 +83,8 @@ class WordTranslator(nodes.NodeVisitor):
         self.in_list = False
         self.in_admonition = False
         self.bookmarks = {}
+        self.section_bookmarks = {}
+        self.inserted_bookmarks = set()
         self.in_link = False
         self.in_table_head = False
         self.remove_carriage_return = False
@@ -80,6 +108,9 @@ class WordTranslator(nodes.NodeVisitor):
         
         if not self.in_litteral_block:
             text = SPACE_REX.subn(" ", text)[0]
+        elif len(text) > CHUNK_SIZE:
+            self.word.addTextChunks(splitChunks(text))
+            return
             
         self.word.addText(text)
 
@@ -264,35 +295,57 @@ class WordTranslator(nodes.NodeVisitor):
         self.cur_column += 1
 
     def depart_definition(self, node):
+        if self.text_table:
+            return
         if self.remove_carriage_return:
             self.remove_carriage_return = False
-            self.word.selection.TypeBackspace()
+            self.word.backspace()
         if (self.cur_row >= self.cur_table_dimensions[0]):
             return
         else:
             self.word.move("right", CST.wdCell)
 
     def visit_definition_list(self, node):
-        self.in_table = True
         rows, cols = len(node.children), 2
         self.cur_table_dimensions = (rows, cols)
-        table = self.word.addTable(rows, cols)
-        self.word.formatTable(table, 
-                              lateral_padding=self.settings.lateral_padding, 
-                              vertical_padding=self.settings.vertical_padding, 
-                              border=False)
-                              
+        self.cur_table_layout = self.table_layout(node, cols)
+        fit = self.cur_table_layout[0]
+        if not self.in_table and is_text_table(node):
+            self.text_table = True
+            self.word.beginTable(rows, cols, fit)
+        else:
+            table = self.word.addTable(rows, cols, fit)
+            self.format_definition_list(table, node)
+        self.in_table = True
 
     def depart_definition_list(self, node):
         self.in_table = False
         self.cur_column = 0
         self.cur_row = 0
-        self.word.move("down", CST.wdLine)
+        if self.text_table:
+            self.text_table = False
+            table = self.word.endTable()
+            self.word.formatColumn(table, 1, bold=True, alignment=CST.wdAlignParagraphRight)
+            self.format_definition_list(table, node)
+        else:
+            self.word.move("down", CST.wdLine)
         self.word.clearFormatting()
 
+    def format_definition_list(self, table, node):
+        fit, widths = self.cur_table_layout
+        self.word.formatTable(table, 
+                              lateral_padding=self.settings.lateral_padding, 
+                              vertical_padding=self.settings.vertical_padding, 
+                              border=False, 
+                              fit=fit, 
+                              widths=widths, 
+                              style=self.table_style(node["classes"]))
+
     def visit_definition_list_item(self, node):
         self.cur_column = 0
         self.cur_row += 1
+        if self.text_table and self.cur_row > 1:
+            self.word.nextRow()
 
     def depart_definition_list_item(self, node):
         pass
@@ -321,16 +374,40 @@ class WordTranslator(nodes.NodeVisitor):
     def visit_document(self, node):
         if self.settings.show_gui: 
             self.word.show()
+        # the references to them become internal links as they are written
+        self.bookmarks, self.section_bookmarks = index_bookmarks(node, self.settings.bookmarks)
+        part = getattr(self.settings, "split_part", None)
+        if part is not None:
+            # only one part of the document is generated (see --split-jobs),
+            # the bookmarks are still named after the whole document
+            node.children = split_parts(node)[part]
+        if self.settings.image_dpi:
+            self.resampler = ImageResampler(self.settings.image_dpi, self.image_cache())
+            # resampled in the background while the text is generated
+            for image in node.traverse(nodes.image):
+                path, size = self.image_source(image)
+                if size is not None:
+                    self.resampler.submit(path, size)
         self.word.setStyle(CST.wdStyleBodyText)
 
     def depart_document(self, node):
-        print "Updating bookmarks..."
-        for link in self.word.getHyperlinks():
-            try:
-                self.bookmarks[link.Address]
-                self.word.convertToInternalHyperlink(link)
-            except KeyError:
-                pass
+        if self.resampler is not None:
+            self.resampler.close()
+            for name, value in sorted(self.resampler.stats.items()):
+                print "    %s: %d" % (name, value)
+        if self.excel_pool is not None:
+            self.excel_pool.close()
+            for name, value in sorted(self.excel_pool.stats.items()):
+                print "    %s: %d" % (name, value)
+            for name, value in sorted(self.excel_pool.times.items()):
+                print "    Excel %s time: %.2fs" % (name, value)
+        print "Creating bookmarks..."
+        start = time.time()
+        count = self.word.flushBookmarks()
+        print "    %d bookmarks in %.2fs" % (count, time.time() - start)
+        print "Writing document properties..."
+        count = self.word.flushDocProperties()
+        print "    %d properties" % count
         print "Updating document fields..."
         self.word.updateFields()
 
@@ -342,13 +419,19 @@ class WordTranslator(nodes.NodeVisitor):
 
     def visit_entry(self, node):
         self.cur_column += 1
-        if self.in_table_head:
+        if self.text_table:
+            # the header rows are made bold by depart_table
+            if self.cur_column > 1:
+                self.word.nextCell()
+        elif self.in_table_head:
             self.word.setFont("Bold")
 
     def depart_entry(self, node):
+        if self.text_table:
+            return
         if self.remove_carriage_return:
             self.remove_carriage_return = False
-            self.word.selection.TypeBackspace()
+            self.word.backspace()
         if (self.cur_row >= self.cur_table_dimensions[0] and 
             self.cur_column >= self.cur_table_dimensions[1]):
             return
@@ -465,23 +548,46 @@ class WordTranslator(nodes.NodeVisitor):
         if isinstance(node.parent, nodes.substitution_definition):
             return
         
-        image_path = node["uri"]
-        
-        if not os.path.isabs(image_path):
-            image_path = os.path.join(self.root_path, image_path)
-        
         if not isinstance(node.parent, nodes.figure):
             self.word.setAlignment(CST.wdAlignParagraphCenter)
         
-        image = self.word.insertImage(os.path.normpath(image_path))
-        
+        image_path, size = self.image_source(node)
+        if size is not None:
+            # the final size is set at insertion, Word does not have to lay
+            # out the picture to tell us its size
+            if self.resampler is not None:
+                image_path = self.resampler.get(image_path, size)
+            self.word.insertImage(image_path, size)
+        else:
+            image = self.word.insertImage(image_path)
+            self.word.scaleImage(image, self.image_scale(node))
+
+    def image_source(self, node):
+        """
+        Returns the path of the image and its displayed size in points,
+        None if its format is unknown.
+        """
+        image_path = node["uri"]
+        if not os.path.isabs(image_path):
+            image_path = os.path.join(self.root_path, image_path)
+        image_path = os.path.normpath(image_path)
+        info = readImageInfo(image_path)
+        if info is None:
+            return image_path, None
+        return image_path, info.size(self.image_scale(node))
+
+    def image_cache(self):
+        if self.settings.image_cache:
+            return self.settings.image_cache
+        return os.path.join(tempfile.gettempdir(), "rst2word-images")
+
+    def image_scale(self, node):
         scale = int(self.settings.image_scale)
         try:
             scale *= int(node["scale"]) / 100.0
         except KeyError:
             pass
-        
-        self.word.scaleImage(image, scale)
+        return scale
 
     def depart_image(self, node):
         self.word.newParagraph()
@@ -602,7 +708,9 @@ class WordTranslator(nodes.NodeVisitor):
             self.word.setStyle(CST.wdStyleBodyText)
 
     def depart_paragraph(self, node):
-        if self.in_table:
+        if self.text_table:
+            pass
+        elif self.in_table:
             self.remove_carriage_return = True
             self.word.newParagraph()
         elif not (self.skip_text or self.in_table):
@@ -628,22 +736,55 @@ class WordTranslator(nodes.NodeVisitor):
         filename = node["source"]
         if not os.path.isabs(filename):
             filename = os.path.join(self.root_path, filename)
-        
+        try:
+            self.insert_raw(node, filename)
+        except ValueError, e:
+            # a sheet or a part that the file does not have
+            self.document.reporter.error("Cannot include %s: %s" % (filename, e), base_node=node)
+
+    def insert_raw(self, node, filename):
         if node["format"] == "excel":
-            xl = Excel(os.path.normpath(filename))
-            xl.copyCells()
-            self.word.pasteExcelTable()
-            xl.close()
+            filename = os.path.normpath(filename)
+            rows = readCells(filename, node.get("sheet"), node.get("range"))
+            if rows is None:
+                # legacy binary workbook, only Excel can read it
+                if self.excel_pool is None:
+                    self.excel_pool = ExcelPool(self.settings.excel_recycle)
+                rows = self.excel_pool.readCells(filename, node.get("sheet"), node.get("range"))
+            self.insert_cells(rows, node)
         elif node["format"] == "powerpoint":
-            self.word.addOLEObject(os.path.normpath(filename))
+            filename = os.path.normpath(filename)
+            image_path = None
+            if self.settings.powerpoint == "thumbnail":
+                image_path = extractThumbnail(filename, self.image_cache(), node.get("image"))
+            if image_path is None:
+                # asked for, or a legacy .ppt file
+                if self.settings.backend == "docx":
+                    raise ValueError("The docx backend cannot embed %s, it has no preview picture" % filename)
+                self.word.addOLEObject(filename)
+            else:
+                self.insert_preview(image_path)
         else:
-            f = open(filename, "r")
-            content = f.read()
+            encoding = node.get("encoding") or self.settings.input_encoding or "utf-8"
             self.word.setStyle(CST.wdStyleHtmlPre)
-            self.word.addText(content)
+            self.word.addTextChunks(readChunks(filename, encoding))
             self.word.newParagraph()
             self.word.clearFormatting()
 
+    def insert_preview(self, image_path):
+        """
+        Inserts the preview of a presentation, as wide as the text.
+        """
+        self.word.setAlignment(CST.wdAlignParagraphCenter)
+        info = readImageInfo(image_path)
+        if info is None:
+            self.word.insertImage(image_path)
+        else:
+            width = self.word.getTextWidth()
+            self.word.insertImage(image_path, (width, width * info.height / float(info.width)))
+        self.word.newParagraph()
+        self.word.clearFormatting()
+
     def depart_raw(self, node):
         self.skip_text = False
 
@@ -655,9 +796,14 @@ class WordTranslator(nodes.NodeVisitor):
             self.in_link = True
             if node.attributes.__contains__("refid"):
                 bookmark_id = ILLEGAL_REX.subn("_", node["refid"])[0]
+                if bookmark_id not in self.bookmarks:
+                    # nothing to link to (--bookmarks=none), keep the text
+                    self.skip_text = False
+                    self.in_link = False
+                    return
+                self.word.insertHyperlink(text=node.astext(), target=self.bookmarks[bookmark_id], internal=True)
             elif node.attributes.__contains__("refuri"):
-                bookmark_id = node["refuri"]
-            self.word.insertHyperlink(text=node.astext(), target=bookmark_id)
+                self.word.insertHyperlink(text=node.astext(), target=node["refuri"])
 
     def depart_reference(self, node):
         if self.in_link:
@@ -673,6 +819,8 @@ class WordTranslator(nodes.NodeVisitor):
     def visit_row(self, node):
         self.cur_column = 0
         self.cur_row += 1
+        if self.text_table and self.cur_row > 1:
+            self.word.nextRow()
     
     def depart_row(self, node):
         pass
@@ -685,16 +833,16 @@ class WordTranslator(nodes.NodeVisitor):
 
     def visit_section(self, node):
         section = Section()
-        self.sections[-1].next_child += 1
-        section.number = self.sections[-1].next_child
-        section.start = self.word.selection.Start
+        section.start = self.word.getCurrentPosition()
+        if node["ids"]:
+            section.bookmark = self.section_bookmarks.get(node["ids"][0])
         self.sections.append(section)
-        section.title = calcSectionNumber(self.sections)
 
     def depart_section(self, node):
         section = self.sections.pop()
-        section.end = self.word.selection.Start
-        self.word.insertBookmark(name=section.title, start=section.start, end=section.end)
+        section.end = self.word.getCurrentPosition()
+        if section.bookmark:
+            self.insert_bookmark(section.bookmark, section.start, section.end)
 
     def visit_sidebar(self, node):
         pass
@@ -759,42 +907,127 @@ class WordTranslator(nodes.NodeVisitor):
         pass
 
     def visit_table(self, node):
-        self.in_table = True
         rows, cols = get_table_size(node)
         self.cur_table_dimensions = (rows, cols)
-        table = self.word.addTable(rows, cols)
+        self.cur_table_layout = self.table_layout(node, cols)
+        fit = self.cur_table_layout[0]
+        if not self.in_table and is_text_table(node):
+            self.text_table = True
+            self.word.beginTable(rows, cols, fit)
+        else:
+            table = self.word.addTable(rows, cols, fit)
+            self.format_table(table, node)
+        self.in_table = True
+
+    def depart_table(self, node):
+        self.in_table = False
+        self.cur_column = 0
+        self.cur_row = 0
+        if self.text_table:
+            self.text_table = False
+            table = self.word.endTable()
+            self.word.boldRows(table, extract_sizes(node, thead=True)[0])
+            self.format_table(table, node)
+        else:
+            self.word.move("down", CST.wdLine)
+        self.word.clearFormatting()
+
+    def insert_cells(self, rows, node):
+        """
+        Inserts the texts of the cells of a spreadsheet as a table with a
+        single table operation, formatted like the rst tables.
+        """
+        if not rows:
+            return
+        cols = max(len(row) for row in rows)
+        rows = [row + [u""] * (cols - len(row)) for row in rows]
+        fit = TABLE_FITS[self.settings.table_fit]
+        widths = None
+        if fit != CST.wdAutoFitContent:
+            widths = estimate_column_widths(zip(*rows), [], 
+                                            total_width=self.word.getTextWidth(), 
+                                            padding=CentimetersToPoints(self.settings.lateral_padding), 
+                                            fill=(fit == CST.wdAutoFitWindow))
+        self.cur_table_layout = (fit, widths)
+        self.word.beginTable(len(rows), cols, fit)
+        for i, row in enumerate(rows):
+            if i > 0:
+                self.word.nextRow()
+            for j, text in enumerate(row):
+                if j > 0:
+                    self.word.nextCell()
+                if text:
+                    self.word.addText(text)
+        table = self.word.endTable()
+        self.format_table(table, node)
+        self.word.clearFormatting()
+
+    def format_table(self, table, node):
+        fit, widths = self.cur_table_layout
         if "no-format" in node["classes"]:
             self.word.formatTable(table, 
                                   lateral_padding=self.settings.lateral_padding, 
                                   vertical_padding=self.settings.vertical_padding, 
-                                  border=False)
+                                  border=False, 
+                                  fit=fit, 
+                                  widths=widths, 
+                                  style=self.table_style(node["classes"]))
         else:
             self.word.formatTable(table=table, 
                                   lateral_padding=self.settings.lateral_padding, 
                                   vertical_padding=self.settings.vertical_padding, 
                                   border=True, 
-                                  first_row_bg_color=CST.wdColorGray15)
-
-    def depart_table(self, node):
-        self.in_table = False
-        self.cur_column = 0
-        self.cur_row = 0
-        self.word.move("down", CST.wdLine)
-        self.word.clearFormatting()
+                                  first_row_bg_color=CST.wdColorGray15, 
+                                  fit=fit, 
+                                  widths=widths, 
+                                  style=self.table_style(node["classes"] + [self.settings.table_style]))
+
+    def table_style(self, names):
+        """
+        Returns the first of the given names that is a table style of the
+        template, None to format the table property by property.
+        """
+        for name in names:
+            # class names are lowercased and their spaces replaced by "-"
+            for candidate in (name, name.replace("-", " ")):
+                if candidate and self.word.hasTableStyle(candidate):
+                    return candidate
+        return None
+
+    def table_layout(self, node, cols):
+        """
+        Returns the AutoFit behavior asked with --table-fit and, unless Word
+        fits the table to its content, the estimated column widths.
+        """
+        fit = TABLE_FITS[self.settings.table_fit]
+        if fit == CST.wdAutoFitContent:
+            return fit, None
+        columns, colwidths = get_columns(node, cols)
+        widths = estimate_column_widths(columns, colwidths, 
+                                        total_width=self.word.getTextWidth(), 
+                                        padding=CentimetersToPoints(self.settings.lateral_padding), 
+                                        fill=(fit == CST.wdAutoFitWindow))
+        return fit, widths
 
     def visit_target(self, node):
         if self.skip_text:
             return
         try:
             bookmark_id = ILLEGAL_REX.subn("_", node["refid"])[0]
-            self.bookmarks[bookmark_id] = bookmark_id
-            self.word.insertBookmark(bookmark_id)
         except KeyError:
-            pass
+            return
+        if bookmark_id in self.bookmarks:
+            self.insert_bookmark(self.bookmarks[bookmark_id])
         
     def depart_target(self, node):
         pass
 
+    def insert_bookmark(self, name, start=0, end=0):
+        # indirect targets have the refid of the target they point to
+        if name not in self.inserted_bookmarks:
+            self.inserted_bookmarks.add(name)
+            self.word.insertBookmark(name=name, start=start, end=end)
+
     def visit_tbody(self, node):
         pass
 
@@ -804,13 +1037,18 @@ class WordTranslator(nodes.NodeVisitor):
     def visit_term(self, node):
         self.cur_column += 1
         self.word.setStyle(CST.wdStyleNormal)
-        self.word.setFont("Bold")
-        self.word.setAlignment(CST.wdAlignParagraphRight)
+        if not self.text_table:
+            # the whole column is formatted by depart_definition_list
+            self.word.setFont("Bold")
+            self.word.setAlignment(CST.wdAlignParagraphRight)
 
     def depart_term(self, node):
+        if self.text_table:
+            self.word.nextCell()
+            return
         if self.remove_carriage_return:
             self.remove_carriage_return = False
-            self.word.selection.TypeBackspace()
+            self.word.backspace()
         self.word.setStyle(CST.wdStyleDefaultParagraphFont)
         self.word.move("right", CST.wdCell)
 
@@ -855,8 +1093,6 @@ class WordTranslator(nodes.NodeVisitor):
             level = len(self.sections) - 1 # we do not take the first section as it is dummy
             if level > 9 : level = 9
             self.word.setStyle(getCST("wdStyleHeading%d" % level))
-            bookmark_id = ILLEGAL_REX.subn("_", node.astext())[0]
-            self.sections[-1].title = self.sections[-1].title + "_" + bookmark_id 
 
 
     def depart_title(self, node):
@@ -915,6 +1151,82 @@ def get_table_size(node):
     cols = max(c_head, c_body)
     return rows, cols
     
+def is_text_table(node):
+    """
+    True if every cell of the table (or definition list) holds at most one
+    paragraph of inline text: it can then be typed as tab separated text
+    and converted to a table at once.
+    """
+    texts = []
+    if isinstance(node, nodes.definition_list):
+        cells = []
+        for item in node.children:
+            if [c.tagname for c in item.children] != ["term", "definition"]:
+                return False
+            term, definition = item.children
+            texts.append(term)
+            cells.append(definition)
+    else:
+        cells = node.traverse(nodes.entry)
+    for cell in cells:
+        if cell.get("morecols") or cell.get("morerows") or len(cell.children) > 1:
+            return False
+        for child in cell.children:
+            if not isinstance(child, nodes.paragraph):
+                return False
+            texts.append(child)
+    for text in texts:
+        for n in text.traverse(include_self=False):
+            if not isinstance(n, (nodes.Text, nodes.Inline)) or isinstance(n, nodes.image):
+                return False
+    return True
+
+def get_columns(node, cols):
+    """
+    Returns the texts of the cells of each column and the colspec widths
+    (empty for definition lists).
+    """
+    columns = [[] for _ in range(cols)]
+    colwidths = []
+    if isinstance(node, nodes.definition_list):
+        for item in node.children:
+            for i, child in enumerate(item.children[:cols]):
+                columns[i].append(child.astext())
+        return columns, colwidths
+    for tgroup in node.children:
+        if tgroup.tagname != "tgroup":
+            continue
+        for child in tgroup.children:
+            if child.tagname == "colspec":
+                colwidths.append(child.get("colwidth", 1))
+            elif child.tagname in ("thead", "tbody"):
+                for row in child.children:
+                    for i, entry in enumerate(row.children[:cols]):
+                        columns[i].append(entry.astext())
+    return columns, colwidths
+
+def estimate_column_widths(columns, colwidths, total_width, padding, fill=False):
+    """
+    Column widths in points. A column gets the mean of its share of the
+    colspec widths and its share of the text, measured by the 90th
+    percentile of the cell lengths so that a few long cells do not take
+    all the room. Unless fill is set the table is not wider than its text.
+    """
+    lengths = []
+    for texts in columns:
+        sizes = sorted(min(len(text), MAX_CELL_CHARS) for text in texts) or [0]
+        lengths.append(max(sizes[min(len(sizes) - 1, int(len(sizes) * 0.9))], 1))
+    total_length = float(sum(lengths))
+    shares = [length / total_length for length in lengths]
+    if len(colwidths) == len(lengths) and sum(colwidths) > 0:
+        total_colwidth = float(sum(colwidths))
+        shares = [(share + colwidth / total_colwidth) / 2 
+                  for share, colwidth in zip(shares, colwidths)]
+    if not fill:
+        natural_width = sum(length * CHAR_WIDTH + 2 * padding for length in lengths)
+        total_width = min(total_width, natural_width)
+    return [share * total_width for share in shares]
+
 def extract_sizes(node, thead=True):
     if thead: tag = "thead"
     else:     tag = "tbody"
@@ -943,12 +1255,94 @@ class Hyperlink:
 class Section:
     start = None
     end = None
-    title = None
-    number = 1
-    next_child = 0
-    
-def calcSectionNumber(sections):
-    number = "T"
-    for s in sections[1:]: # we ignore the first dummy section
-        number += "_%d" % s.number
-    return number
+    bookmark = None
+
+# Word refuses longer bookmark names
+MAX_BOOKMARK_LENGTH = 40
+# and names with anything else than letters, digits and "_"
+BOOKMARK_ILLEGAL_REX = re.compile(r"\W+", re.U)
+
+class BookmarkNames:
+    """
+    Gives unique bookmark names that Word accepts. Only the names given so
+    far are checked, the bookmarks of the document are never looked at.
+    """
+
+    def __init__(self):
+        self.used = set()
+
+    def make(self, name):
+        name = BOOKMARK_ILLEGAL_REX.sub("_", name)
+        if not name[:1].isalpha():
+            # names starting with "_" are hidden bookmarks
+            name = "B" + name
+        name = name[:MAX_BOOKMARK_LENGTH]
+        unique = name
+        count = 1
+        # Word ignores the case of bookmark names
+        while unique.lower() in self.used:
+            count += 1
+            suffix = "_%d" % count
+            unique = name[:MAX_BOOKMARK_LENGTH - len(suffix)] + suffix
+        self.used.add(unique.lower())
+        return unique
+
+def split_parts(document):
+    """
+    Returns the children of the document by part: each top-level section
+    with what follows it, what comes before the first one goes with it.
+    """
+    parts = [[]]
+    for child in document.children:
+        if isinstance(child, nodes.section) and [c for c in parts[-1] if isinstance(c, nodes.section)]:
+            parts.append([])
+        parts[-1].append(child)
+    return parts
+
+def index_bookmarks(document, mode="all"):
+    """
+    Names the bookmarks to create, before anything is written, so that links
+    can point to them directly. Returns two dicts: the bookmark of everything
+    that can be linked to, by sanitized id, and the bookmark of each section,
+    by its first id. Explicit targets have their own bookmark, sections are
+    bookmarked with their number and title. With mode "referenced", only what
+    a reference points to gets a bookmark, with "none" nothing does.
+    """
+    bookmarks = {}
+    sections = {}
+    if mode == "none":
+        return bookmarks, sections
+    referenced = None
+    if mode == "referenced":
+        referenced = set()
+        for reference in document.traverse(nodes.reference):
+            if reference.hasattr("refid"):
+                referenced.add(ILLEGAL_REX.subn("_", reference["refid"])[0])
+    names = BookmarkNames()
+
+    for target in document.traverse(nodes.target):
+        if target.hasattr("refid"):
+            bookmark_id = ILLEGAL_REX.subn("_", target["refid"])[0]
+            if bookmark_id in bookmarks:
+                continue
+            if referenced is None or bookmark_id in referenced:
+                bookmarks[bookmark_id] = names.make(bookmark_id)
+
+    def index_sections(node, number):
+        count = 0
+        for child in node.children:
+            if isinstance(child, nodes.section):
+                count += 1
+                child_number = "%s_%d" % (number, count)
+                ids = [ILLEGAL_REX.subn("_", id)[0] for id in child["ids"]]
+                if ids and (referenced is None or referenced.intersection(ids)):
+                    name = child_number
+                    if child.children and isinstance(child[0], nodes.title):
+                        name += "_" + ILLEGAL_REX.subn("_", child[0].astext())[0]
+                    name = names.make(name)
+                    sections[child["ids"][0]] = name
+                    for id in ids:
+                        bookmarks.setdefault(id, name)
+                index_sections(child, child_number)
+    index_sections(document, "T")
+    return bookmarks, sections
@@ -4,31 +4,246 @@ This file is part of docutils
 Created on 26 oct. 2010
 @author: diabeteman
 '''
-import win32com.client as WIN
+try:
+    import win32com.client as WIN
+except ImportError:
+    # not on Windows or PyWin32 is missing, only the docx backend is usable
+    WIN = None
+try:
+    import psutil, win32gui, win32process
+except ImportError:
+    # only needed to recycle pooled Word instances on memory (--word-max-memory)
+    psutil = None
 from rst2wordlib.constants import Constants as CST
+from rst2wordlib.spreadsheets import cellText
 import os.path
 from distutils import dir_util
+import re, zipfile, time, io
+
+# built-in styles applied to characters, all the others are paragraph styles
+CHARACTER_STYLES = set([CST.wdStyleDefaultParagraphFont, CST.wdStyleEmphasis,
+                        CST.wdStyleStrong, CST.wdStyleHtmlCode])
+
+NEWLINE_REX = re.compile(r"\r\n|\n")
+
+# characters inserted at once by addTextChunks, completed to the end of line
+CHUNK_SIZE = 64 * 1024
+
+BUILTIN_PROPERTIES = set(["Title", "Subject", "Author", "Comments", "Revision number", "Company"])
+
+FIELD_REX = re.compile(r"<w:fldSimple|<w:instrText")
+TEXT_BOX_REX = re.compile(r"<w:txbxContent.*?</w:txbxContent>", re.S)
+TOC_REX = re.compile(r'<w:instrText[^>]*>\s*TOC\b|<w:fldSimple w:instr="\s*TOC\b')
+
+# template path -> (mtime, size, TemplateFields)
+_template_cache = {}
 
 class Excel:
 
-    def __init__(self, filename):
+    def __init__(self, filename=None):
+        checkCOM()
         self.xlApp = WIN.dynamic.Dispatch("Excel.Application")
         self.xlApp.DisplayAlerts = 0 # disable confirmation requests
-        self.xlApp.Workbooks.Open(filename)
+        self.workbook = None
+        if filename is not None:
+            self.open(filename)
 
     def show(self):
         # convenience when debugging
         self.xlApp.Visible = 1
 
-    def copyCells(self):
-        self.xlApp.ActiveWorkbook.ActiveSheet.Cells.Select()
-        self.xlApp.Selection.Copy()
+    def open(self, filename):
+        self.workbook = self.xlApp.Workbooks.Open(filename, ReadOnly=True)
+
+    def readCells(self, sheet=None, cells=None):
+        """
+        Returns the texts of the cells of a sheet (name or number, the active
+        one by default), rows of the used range or of the given range
+        ("A1:D20"), read at once.
+        """
+        if sheet is None:
+            worksheet = self.workbook.ActiveSheet
+        elif sheet.isdigit():
+            worksheet = self.workbook.Worksheets(int(sheet))
+        else:
+            worksheet = self.workbook.Worksheets(sheet)
+        if cells is None:
+            values = worksheet.UsedRange.Value
+        else:
+            values = worksheet.Range(cells).Value
+        if not isinstance(values, tuple):
+            # a single cell
+            values = ((values,),)
+        return [[cellText(value) for value in row] for row in values]
+
+    def closeWorkbook(self):
+        if self.workbook is not None:
+            self.workbook.Close(SaveChanges=False)
+            self.workbook = None
 
     def close(self):
+        self.closeWorkbook()
         self.xlApp.Quit()
 
 
 
+class ExcelPool:
+    """
+    Keeps one Excel application for all the workbooks of a conversion
+    instead of starting one for each. It is restarted every max_uses
+    workbooks, and after an error since Excel may be left in any state.
+    """
+
+    def __init__(self, max_uses=20):
+        self.max_uses = max_uses
+        self.excel = None
+        self.uses = 0
+        self.stats = {"Excel starts": 0, "Excel workbooks": 0, "Excel errors": 0}
+        self.times = {"start": 0.0, "open": 0.0, "read": 0.0, "close": 0.0}
+
+    def readCells(self, filename, sheet=None, cells=None):
+        """
+        Returns the texts of the cells of a workbook (see Excel.readCells).
+        """
+        excel = self.acquire()
+        try:
+            self.timed("open", excel.open, filename)
+            rows = self.timed("read", excel.readCells, sheet, cells)
+            self.timed("close", excel.closeWorkbook)
+        except:
+            self.stats["Excel errors"] += 1
+            self.close()
+            raise
+        self.release()
+        return rows
+
+    def acquire(self):
+        if self.excel is None:
+            self.excel = self.timed("start", Excel)
+            self.uses = 0
+            self.stats["Excel starts"] += 1
+        return self.excel
+
+    def release(self):
+        self.uses += 1
+        self.stats["Excel workbooks"] += 1
+        if self.max_uses and self.uses >= self.max_uses:
+            self.close()
+
+    def close(self):
+        if self.excel is not None:
+            excel, self.excel = self.excel, None
+            try:
+                excel.close()
+            except Exception:
+                # already gone, nothing more to release
+                pass
+
+    def timed(self, name, function, *args):
+        start = time.time()
+        try:
+            return function(*args)
+        finally:
+            self.times[name] += time.time() - start
+
+
+
+class WordPool:
+    """
+    Keeps Word applications started between conversions, so that each one
+    does not wait for Word to start and load the template. size instances
+    are started on the first request. An instance is checked before being
+    handed out. It is restarted after max_documents documents, or when its
+    memory goes over max_memory megabytes.
+    """
+
+    def __init__(self, size=1, max_documents=50, max_memory=0):
+        if max_memory and psutil is None:
+            raise ImportError("psutil is required to recycle Word on memory (--word-max-memory)")
+        self.size = size
+        self.max_documents = max_documents
+        self.max_memory = max_memory
+        self.idle = []
+        # application -> documents generated, template document, process id
+        self.documents = {}
+        self.templates = {}
+        self.pids = {}
+        self.stats = {"Word starts": 0, "Word reuses": 0, "Word recycled": 0}
+
+    def acquire(self, templatefile=None):
+        if not self.documents:
+            for _ in range(self.size):
+                self.idle.append(self.start(templatefile))
+        while self.idle:
+            app = self.idle.pop(0)
+            if self.isHealthy(app):
+                if self.documents[app]:
+                    # not the first document of this instance
+                    self.stats["Word reuses"] += 1
+                return app
+            self.discard(app)
+        return self.start(templatefile)
+
+    def release(self, app):
+        self.documents[app] += 1
+        if self.max_documents and self.documents[app] >= self.max_documents:
+            self.discard(app)
+        elif self.max_memory and processMemory(self.pids[app]) > self.max_memory * 1024 * 1024:
+            self.discard(app)
+        else:
+            self.idle.append(app)
+
+    def detach(self, app):
+        """
+        Gives up an application left to the user.
+        """
+        self.documents.pop(app, None)
+        self.templates.pop(app, None)
+        self.pids.pop(app, None)
+
+    def watch(self, app, doc):
+        """
+        Finds the process of an application from the window of one of its
+        documents, once, if its memory is checked.
+        """
+        if self.max_memory and app not in self.pids:
+            self.pids[app] = processId(app, doc)
+
+    def close(self):
+        while self.idle:
+            self.discard(self.idle.pop())
+
+    def start(self, templatefile):
+        app = WIN.dynamic.Dispatch("Word.Application")
+        app.DisplayAlerts = 0 # disable confirmation requests
+        # named so that its window, and its process, can be found
+        app.Caption = "rst2word %d" % id(app)
+        self.documents[app] = 0
+        self.templates[app] = None
+        if templatefile is not None:
+            # keeps the template loaded for the documents based on it
+            self.templates[app] = app.Documents.Add(Template=templatefile, Visible=False)
+        self.stats["Word starts"] += 1
+        return app
+
+    def isHealthy(self, app):
+        try:
+            # only the template document may be left open
+            return app.Documents.Count <= 1
+        except Exception:
+            return False
+
+    def discard(self, app):
+        self.detach(app)
+        self.stats["Word recycled"] += 1
+        try:
+            app.Quit(SaveChanges=False)
+        except Exception:
+            # already gone, nothing more to release
+            pass
+
+
+
 class Word:
     """
     Wrapper aroud Word 8 documents to make them easy to build.
@@ -39,25 +254,79 @@ class Word:
     
         
 
-    def __init__(self, templatefile=None):
-        self.wordApp = WIN.dynamic.Dispatch("Word.Application")
-        self.wordApp.DisplayAlerts = 0 # disable confirmation requests
-
-        if templatefile == None:
-            self.doc = self.wordApp.Documents.Add()
+    def __init__(self, templatefile=None, pool=None):
+        checkCOM()
+        # Word instances started before, kept between documents (see WordPool)
+        self.pool = pool
+        if pool is None:
+            self.wordApp = WIN.dynamic.Dispatch("Word.Application")
+            self.wordApp.DisplayAlerts = 0 # disable confirmation requests
         else:
-            self.doc = self.wordApp.Documents.Add(Template=templatefile)
+            self.wordApp = pool.acquire(templatefile)
+
+        try:
+            if templatefile == None:
+                self.doc = self.wordApp.Documents.Add()
+            else:
+                self.doc = self.wordApp.Documents.Add(Template=templatefile)
+        except Exception:
+            # a missing template for instance, the instance can still be used
+            if pool is not None:
+                pool.release(self.wordApp)
+            raise
+        if pool is not None:
+            pool.watch(self.wordApp, self.doc)
 
         #set up the selection
         self.doc.Range(0, 0).Select()
         self.selection = self.wordApp.Selection
 
+        # text typed with addText is buffered until something else
+        # than text is inserted (see flushText)
+        self.text_buffer = []
+        self.stats = {"text insertions": 0, "TypeText calls": 0, "COM calls saved": 0,
+                      "formatting calls skipped": 0, "list templates reused": 0,
+                      "field stories updated": 0, "text chunks": 0}
+
+        # formatting at the selection as far as we know, None means unknown.
+        # setStyle/setFont/clearFormatting are only recorded and reach COM
+        # before the next insertion if they change something (see applyFormat)
+        self.style_names = {}
+        self.next_styles = {}
+        self.table_styles = {}
+        self.table_start = None
+        # (name, start, end) of the bookmarks to create (see flushBookmarks)
+        self.bookmarks = []
+        self.list_templates = {}
+        # document properties, written by flushDocProperties
+        self.properties = {}
+        self.written_properties = {}
+        # lower case names of the custom properties of the document
+        self.custom_property_names = None
+        # kinds of the fields inserted, to update only what needs it
+        self.fields = set()
+        self.template_fields = analyzeTemplate(templatefile)
+        self.pending_clear = False
+        self.pending_paragraph_style = None
+        self.pending_character_style = None
+        self.font_buffer = set()
+        self.forgetFormat()
+        self.text_width = None
+
     def show(self):
         # convenience when debugging
         self.wordApp.Visible = 1
 
     def quit(self, saveChanges=False):
-        self.wordApp.Quit(SaveChanges=saveChanges)
+        if self.pool is None:
+            self.wordApp.Quit(SaveChanges=saveChanges)
+        else:
+            # only the document goes, Word is kept for the next one
+            try:
+                self.doc.Close(SaveChanges=saveChanges)
+            finally:
+                # released even so, the pool checks it before the next one
+                self.pool.release(self.wordApp)
 
     def getStyleList(self):
         # returns a dictionary of the styles in a document
@@ -70,6 +339,7 @@ class Word:
         return self.styles
 
     def saveAs(self, filename):
+        self.flushText()
         dir = os.path.abspath(os.path.dirname(filename))
         if not os.path.exists(dir):
             dir_util.mkpath(dir)
@@ -129,6 +399,7 @@ class Word:
                                 SaveAsAOCELetter=False)
     
     def saveAsPdf(self, filename, show_after_export=False):
+        self.flushText()
         dir = os.path.abspath(os.path.dirname(filename))
         if not os.path.exists(dir):
             dir_util.mkpath(dir)
@@ -150,64 +421,249 @@ class Word:
 
     
     def printout(self):
+        self.flushText()
         self.doc.PrintOut()
 
     def selectEnd(self):
         self.selection.Collapse(CST.wdCollapseEnd)
 
     def addText(self, text):
+        if self.hasPendingFormat():
+            # pending formatting applies to the text that follows it
+            self.flushText()
+        self.text_buffer.append(text)
+        self.stats["text insertions"] += 1
+
+    def flushText(self):
+        """
+        Types all the buffered text in one call, then applies the pending
+        formatting. Must be called before anything that changes the
+        paragraph or the position of the selection.
+        """
+        if self.text_buffer:
+            self.typeText("".join(self.text_buffer))
+            self.stats["TypeText calls"] += 1
+            # each coalesced insertion spares a TypeText and a Collapse
+            self.stats["COM calls saved"] += 2 * (len(self.text_buffer) - 1)
+            self.text_buffer = []
+        if self.hasPendingFormat():
+            self.applyFormat()
+
+    def typeText(self, text):
         self.selection.TypeText(text)
         self.selectEnd()
 
-    def addStyledText(self, text, style):
-        self.selection.Style = style
-        self.selection.TypeText(text)
+    def addTextChunks(self, chunks):
+        """
+        Inserts a large text given as an iterable of chunks (see readChunks
+        and splitChunks) with the current formatting, one chunk at a time so
+        that neither Python nor COM ever hold all of it.
+        """
+        self.flushText()
+        for chunk in chunks:
+            self.insertChunk(NEWLINE_REX.sub("\r", chunk))
+            self.stats["text chunks"] += 1
+        self.forgetFormat()
+
+    def insertChunk(self, text):
+        # TypeText gets very slow on long strings, InsertAfter does not
+        self.selection.InsertAfter(text)
         self.selectEnd()
-        self.selection.Style = CST.wdStyleDefaultParagraphFont
 
+    def hasPendingFormat(self):
+        return (self.pending_clear or self.pending_paragraph_style is not None
+                or self.pending_character_style is not None or self.font_buffer)
+
+    def applyFormat(self):
+        """
+        Brings the formatting of the selection to what was asked with
+        clearFormatting/setStyle/setFont since the last text insertion,
+        only calling COM for what really changes.
+        """
+        if self.pending_clear:
+            if self.isCharacterFormatClear() and not self.direct_formatting:
+                # only the paragraph style may differ
+                self.stats["formatting calls skipped"] += 1
+                if self.pending_paragraph_style is None:
+                    self.pending_paragraph_style = CST.wdStyleNormal
+            else:
+                self.selection.ClearFormatting()
+                self.paragraph_style = self.styleName(CST.wdStyleNormal)
+                self.character_style = CST.wdStyleDefaultParagraphFont
+                self.font_toggles = set()
+                self.direct_formatting = False
+            self.pending_clear = False
+
+        if self.pending_paragraph_style is not None:
+            name = self.styleName(self.pending_paragraph_style)
+            if name == self.paragraph_style:
+                self.stats["formatting calls skipped"] += 1
+            else:
+                self.selection.Style = self.pending_paragraph_style
+                self.paragraph_style = name
+                if not self.isCharacterFormatClear():
+                    self.character_style = None
+                    self.font_toggles = None
+            self.pending_paragraph_style = None
+
+        if self.pending_character_style is not None:
+            if (self.pending_character_style == self.character_style
+                    and self.font_toggles == set()):
+                self.stats["formatting calls skipped"] += 1
+            else:
+                self.selection.Style = self.pending_character_style
+                self.character_style = self.pending_character_style
+                self.font_toggles = set()
+            self.pending_character_style = None
+
+        for font in sorted(self.font_buffer):
+            self.selection.Font.__setattr__(font, CST.wdToggle)
+        if self.font_toggles is not None:
+            self.font_toggles ^= self.font_buffer
+        self.font_buffer = set()
+
+    def isCharacterFormatClear(self):
+        return (self.character_style == CST.wdStyleDefaultParagraphFont
+                and self.font_toggles == set())
+
+    def forgetFormat(self):
+        """
+        Called when the selection moves somewhere we know nothing about.
+        """
+        self.paragraph_style = None
+        self.character_style = None
+        self.font_toggles = None
+        self.direct_formatting = True
+
+    def styleName(self, style):
+        if style not in self.style_names:
+            self.style_names[style] = self.doc.Styles(style).NameLocal
+        return self.style_names[style]
 
-    def addTable(self, rows, cols):
-        return self.doc.Tables.Add(Range=self.selection.Range, 
-                                   NumRows=rows, 
-                                   NumColumns=cols, 
-                                   DefaultTableBehavior=0, 
-                                   AutoFitBehavior=CST.wdAutoFitContent)
+    def nextStyleName(self, name):
+        if name not in self.next_styles:
+            self.next_styles[name] = self.doc.Styles(name).NextParagraphStyle.NameLocal
+        return self.next_styles[name]
 
+    def addStyledText(self, text, style):
+        self.setStyle(style)
+        self.addText(text)
+        self.setStyle(CST.wdStyleDefaultParagraphFont)
+
+
+    def addTable(self, rows, cols, fit=CST.wdAutoFitContent):
+        self.flushText()
+        table = self.doc.Tables.Add(Range=self.selection.Range, 
+                                    NumRows=rows, 
+                                    NumColumns=cols, 
+                                    DefaultTableBehavior=0, 
+                                    AutoFitBehavior=fit)
+        self.forgetFormat()
+        return table
+
+
+    def beginTable(self, rows, cols, fit=CST.wdAutoFitContent):
+        """
+        Starts a table typed as text, cells separated by tabs (nextCell) and
+        rows by paragraph marks (nextRow). endTable turns it into a real
+        table with a single ConvertToTable call.
+        """
+        self.table_start = self.getCurrentPosition()
+        self.table_size = (rows, cols)
+        self.table_fit = fit
 
-    def pasteExcelTable(self):
-        self.selection.PasteExcelTable(False, #link with excel ?
-                                       False, #word formatting ?
-                                       False) #RTF ?
+    def nextCell(self):
+        self.addText("\t")
+
+    def nextRow(self):
+        self.newParagraph()
+
+    def endTable(self):
+        # the paragraph mark of the last row stays after the table
+        self.newParagraph()
+        end = self.getCurrentPosition() - 1
+        rows, cols = self.table_size
+        table = self.doc.Range(self.table_start, end).ConvertToTable(Separator=CST.wdSeparateByTabs, 
+                                                                     NumRows=rows, 
+                                                                     NumColumns=cols, 
+                                                                     DefaultTableBehavior=CST.wdWord8TableBehavior, 
+                                                                     AutoFitBehavior=self.table_fit)
+        self.table_start = None
+        self.forgetFormat()
+        return table
+
+    def boldRows(self, table, count):
+        for i in range(1, count + 1):
+            table.Rows(i).Range.Font.Bold = True
+
+    def formatColumn(self, table, index, bold=False, alignment=None):
+        # a column is not a range, only the selection can format it at once
+        self.flushText()
+        here = self.selection.Range
+        table.Columns(index).Select()
+        if bold:
+            self.selection.Font.Bold = True
+        if alignment is not None:
+            self.selection.ParagraphFormat.Alignment = alignment
+        here.Select()
 
     def setDocProperty(self, name, value):
-        if name in ["Title", "Subject", "Author", "Comments", "Revision number", "Company"]:
-            self.doc.BuiltInDocumentProperties[name] = value
-        else:
-            try:
-                self.doc.CustomDocumentProperties[name] = value
-            except:
-                self.doc.CustomDocumentProperties.Add(name, False, 4, value)
+        # written by flushDocProperties
+        self.properties[name] = value
 
     def getDocProperty(self, name):
-        try:
-            if name in ["Title", "Subject", "Author", "Comments", "Revision number", "Company"]:
-                return self.doc.BuiltInDocumentProperties[name].Value
+        return self.properties.get(name, "")
+
+    def flushDocProperties(self):
+        """
+        Writes the properties set since the last call, returns how many.
+        Must be called before updating the fields that display them.
+        """
+        if self.custom_property_names is None:
+            self.custom_property_names = set()
+            for prop in self.doc.CustomDocumentProperties:
+                self.custom_property_names.add(prop.Name.lower())
+        count = 0
+        for name, value in self.properties.items():
+            if self.written_properties.get(name) == value:
+                continue
+            if name in BUILTIN_PROPERTIES:
+                self.doc.BuiltInDocumentProperties[name] = value
+            elif name.lower() in self.custom_property_names:
+                self.doc.CustomDocumentProperties[name] = value
             else:
-                return self.doc.CustomDocumentProperties[name].Value
-        except:
-            return ""
+                self.doc.CustomDocumentProperties.Add(name, False, 4, value)
+                self.custom_property_names.add(name.lower())
+            self.written_properties[name] = value
+            count += 1
+        return count
 
     def insertField(self, doc_property_name):
+        self.flushText()
+        self.fields.add("DOCPROPERTY")
         self.selection.Fields.Add(Range=self.selection.Range, 
                                   Type=CST.wdFieldEmpty, 
                                   Text="DOCPROPERTY  %s " % doc_property_name, 
                                   PreserveFormatting=True)
+        self.forgetFormat()
 
     def setStyle(self, style):
-        self.selection.Style = style
+        # applied by flushText, only if it changes anything
+        if style in CHARACTER_STYLES:
+            self.pending_character_style = style
+            # applying a character style also resets the font toggles
+            self.font_buffer = set()
+        else:
+            self.pending_paragraph_style = style
 
     def setFont(self, font):
-        self.selection.Font.__setattr__(font, CST.wdToggle)
+        # Font.<attr> = wdToggle, two toggles of the same attribute
+        # before any text cancel each other
+        if font in self.font_buffer:
+            self.font_buffer.discard(font)
+            self.stats["formatting calls skipped"] += 2
+        else:
+            self.font_buffer.add(font)
 
 
     def insertTableOfContents(self, depth=3):
@@ -216,6 +672,8 @@ class Word:
         [UseFields], [TableID], [RightAlignPageNumbers], [IncludePageNumbers], [AddedStyles], 
         [UseHyperlinks], [HidePageNumbersInWeb], [UseOutlineLevels]) As TableOfContents
         """
+        self.flushText()
+        self.fields.add("TOC")
         
         # COM/DCOM has a problem with the "UseHyperlinks" parameter
         # it should accept a boolean value, but it doesn't.
@@ -237,43 +695,93 @@ class Word:
         toc.TabLeader = CST.wdTabLeaderDots
         self.doc.TablesOfContents.Format = CST.wdIndexIndent
         self.selectEnd()
+        self.forgetFormat()
         
     def updateFields(self):
-        for table in self.doc.TablesOfContents:
-            table.Update()
+        """
+        Updates the fields of the stories that can contain some: the main
+        story if fields were inserted, the text boxes, headers and footers
+        only if the template has fields there. Everything is updated when
+        the template could not be analyzed.
+        """
+        self.flushBookmarks()
+        self.flushDocProperties()
+        template = self.template_fields
+        if template is None:
+            template = TemplateFields(True)
 
-        self.doc.Range().Fields.Update()
+        if "TOC" in self.fields or template.toc:
+            for table in self.doc.TablesOfContents:
+                table.Update()
+            self.stats["field stories updated"] += 1
 
-        for shape in self.doc.Shapes:
+        # the tables of contents are already up to date
+        if self.fields - set(["TOC"]) or template.body:
+            self.doc.Range().Fields.Update()
+            self.stats["field stories updated"] += 1
+
+        if template.body_shapes:
+            self.updateShapeFields(self.doc.Shapes)
+
+        if template.headers:
+            for section in self.doc.Sections:
+                for header in section.Headers:
+                    header.Range.Fields.Update()
+                for footer in section.Footers:
+                    footer.Range.Fields.Update()
+                self.stats["field stories updated"] += 1
+
+        if template.header_shapes:
+            # the shapes of all the headers and footers of the document
+            self.updateShapeFields(self.doc.Sections(1).Headers(1).Shapes)
+
+    def updateShapeFields(self, shapes):
+        for shape in shapes:
             if shape.TextFrame.HasText:
                 shape.TextFrame.TextRange.Fields.Update()
+                self.stats["field stories updated"] += 1
 
-        for section in self.doc.Sections:
-            for header in section.Headers:
-                header.Range.Fields.Update()
-                for shape in header.Shapes:
-                    if shape.TextFrame.HasText:
-                        shape.TextFrame.TextRange.Fields.Update()
-            for footer in section.Footers:
-                footer.Range.Fields.Update()
-                for shape in footer.Shapes:
-                    if shape.TextFrame.HasText:
-                        shape.TextFrame.TextRange.Fields.Update()
+    def insertFile(self, filename):
+        """
+        Inserts the content of a document at the end of this one, with its
+        bookmarks, links and fields.
+        """
+        self.flushText()
+        end = self.doc.Content.End - 1
+        self.doc.Range(end, end).InsertFile(FileName=filename)
+        self.doc.Range(self.doc.Content.End - 1, self.doc.Content.End - 1).Select()
+        self.forgetFormat()
 
     def insertPageBreak(self):
+        self.flushText()
         self.selection.InsertBreak(7)
         self.selectEnd()
+        self.forgetFormat()
 
     def newParagraph(self):
+        self.flushText()
         self.selection.TypeParagraph()
+        if self.paragraph_style is not None:
+            next_style = self.nextStyleName(self.paragraph_style)
+            if next_style != self.paragraph_style and not self.isCharacterFormatClear():
+                self.character_style = None
+                self.font_toggles = None
+            self.paragraph_style = next_style
 
     def setAlignment(self, alignment):
+        self.flushText()
         self.selection.ParagraphFormat.Alignment = alignment
+        self.direct_formatting = True
 
-    def insertImage(self, image_path):
+    def insertImage(self, image_path, size=None):
+        self.flushText()
         image = self.selection.InlineShapes.AddPicture(FileName=image_path,
                                                        LinkToFile=False, SaveWithDocument=True)
+        if size is not None:
+            # (width, height) in points, known without asking Word
+            image.Width, image.Height = size
         self.selectEnd()
+        self.forgetFormat()
 
         return image
 
@@ -283,7 +791,9 @@ class Word:
         image.Height = image.Height * (scale / 100.0)
 
     def addCaption(self, text, figure, auto=False, label="Figure"):
+        self.flushText()
         if auto:
+            self.fields.add("SEQ")
             figure.Select()
             self.wordApp.Selection.InsertCaption(Label=label, TitleAutoText="", Title=" " + text,
                                                  Position=1, ExcludeLabel=0)
@@ -291,10 +801,12 @@ class Word:
             self.selection.Style = CST.wdStyleCaption
 
         self.selectEnd()
+        self.forgetFormat()
         self.newParagraph()
         self.clearFormatting()
 
     def move(self, direction, unit=CST.wdCell, count=1):
+        self.flushText()
         if direction == "left":
             self.selection.MoveLeft(Unit=unit, Count=count)
         elif direction == "right":
@@ -303,6 +815,7 @@ class Word:
             self.selection.MoveUp(Unit=unit, Count=count)
         elif direction == "down":
             self.selection.MoveDown(Unit=unit, Count=count)
+        self.forgetFormat()
     
     def formatTables(self, style=CST.wdTableFormatProfessional, fit=CST.wdAutoFitContent, align=CST.wdAlignRowCenter):
         for t in self.doc.Tables:
@@ -310,29 +823,39 @@ class Word:
     
     def formatTable(self, table, lateral_padding=0.25, vertical_padding=0.15, 
                     border=False, first_row_bg_color=CST.wdColorAutomatic, 
-                    fit=CST.wdAutoFitContent, align=CST.wdAlignRowCenter):
+                    fit=CST.wdAutoFitContent, align=CST.wdAlignRowCenter, widths=None, style=None):
 
-        table.TopPadding = CentimetersToPoints(vertical_padding)
-        table.BottomPadding = CentimetersToPoints(vertical_padding)
-        table.LeftPadding = CentimetersToPoints(lateral_padding)
-        table.RightPadding = CentimetersToPoints(lateral_padding)
-            
         if first_row_bg_color != CST.wdColorAutomatic:
             table.Rows.AllowBreakAcrossPages = False
             table.Rows.First.HeadingFormat = True
-            table.Rows.First.Cells.Shading.Texture = CST.wdTextureNone
-            table.Rows.First.Cells.Shading.ForegroundPatternColor = CST.wdColorAutomatic
-            table.Rows.First.Cells.Shading.BackgroundPatternColor = first_row_bg_color
-        
-        if border:
-            setBorder(table.Borders(CST.wdBorderLeft))
-            setBorder(table.Borders(CST.wdBorderRight))
-            setBorder(table.Borders(CST.wdBorderTop))
-            setBorder(table.Borders(CST.wdBorderBottom))
-            setBorder(table.Borders(CST.wdBorderHorizontal))
-            setBorder(table.Borders(CST.wdBorderVertical))
+
+        if style is not None:
+            # borders, shading and padding come from the template
+            table.Style = style
+        else:
+            table.TopPadding = CentimetersToPoints(vertical_padding)
+            table.BottomPadding = CentimetersToPoints(vertical_padding)
+            table.LeftPadding = CentimetersToPoints(lateral_padding)
+            table.RightPadding = CentimetersToPoints(lateral_padding)
+            
+            if first_row_bg_color != CST.wdColorAutomatic:
+                table.Rows.First.Cells.Shading.Texture = CST.wdTextureNone
+                table.Rows.First.Cells.Shading.ForegroundPatternColor = CST.wdColorAutomatic
+                table.Rows.First.Cells.Shading.BackgroundPatternColor = first_row_bg_color
+            
+            if border:
+                setBorder(table.Borders(CST.wdBorderLeft))
+                setBorder(table.Borders(CST.wdBorderRight))
+                setBorder(table.Borders(CST.wdBorderTop))
+                setBorder(table.Borders(CST.wdBorderBottom))
+                setBorder(table.Borders(CST.wdBorderHorizontal))
+                setBorder(table.Borders(CST.wdBorderVertical))
                 
         table.Rows.Alignment = align
+        if widths:
+            # known widths, Word does not have to measure the cells
+            for i, width in enumerate(widths):
+                table.Columns(i + 1).Width = width
         table.AutoFitBehavior(fit)
     
         self.selectEnd()
@@ -341,45 +864,105 @@ class Word:
         for table in self.doc.Tables:
             table.AutoFitBehavior(fit)
 
+    def hasTableStyle(self, name):
+        if name not in self.table_styles:
+            try:
+                self.table_styles[name] = self.doc.Styles(name).Type == CST.wdStyleTypeTable
+            except:
+                # not defined in the template
+                self.table_styles[name] = False
+        return self.table_styles[name]
+
+    def getTextWidth(self):
+        # in points, the room between the margins
+        if self.text_width is None:
+            setup = self.doc.PageSetup
+            self.text_width = setup.PageWidth - setup.LeftMargin - setup.RightMargin
+        return self.text_width
+
     def insertBookmark(self, name, start=0, end=0):
-        if start and end:
-            range = self.doc.Range(start, end)
-            self.doc.Bookmarks.Add(Range=range, Name=name)
+        """
+        Only records the bookmark, flushBookmarks creates them all at once.
+        The recorded positions stay right as long as everything is inserted
+        at the cursor, which is after them.
+        """
+        if not (start and end):
+            start = end = self.getCurrentPosition()
+        if self.table_start is not None:
+            # the text of a table being typed moves when it is converted
+            self.doc.Bookmarks.Add(Range=self.doc.Range(start, end), Name=name)
         else:
-            self.doc.Bookmarks.Add(Range=self.selection.Range, Name=name)
-        self.selectEnd()
+            self.bookmarks.append((name, start, end))
+
+    def flushBookmarks(self):
+        """
+        Creates the recorded bookmarks, returns how many. Must be called
+        before updating the fields, which changes the length of the TOC.
+        """
+        self.flushText()
+        for name, start, end in self.bookmarks:
+            self.doc.Bookmarks.Add(Range=self.doc.Range(start, end), Name=name)
+        count = len(self.bookmarks)
+        self.bookmarks = []
+        return count
     
-    def insertHyperlink(self, text, target):
-        if target.startswith("_"):
+    def insertHyperlink(self, text, target, internal=False):
+        self.flushText()
+        if internal or target.startswith("_"):
             self.doc.Hyperlinks.Add(Anchor=self.selection.Range, Address="",
                                     SubAddress=target, ScreenTip="", TextToDisplay=text)
         else:
             self.doc.Hyperlinks.Add(Anchor=self.selection.Range, Address=target, 
                                     SubAddress="", ScreenTip="", TextToDisplay=text)
-    
-    def convertToInternalHyperlink(self, link):
-        target = link.Address
-        text = link.TextToDisplay
-        
-        link.Range.Fields(1).Result.Select()
-        link.Delete()
-        self.doc.Hyperlinks.Add(Anchor=self.selection.Range, Address="", 
-                                SubAddress=target, ScreenTip="", TextToDisplay=text)
-        self.selectEnd()
-    
-    def getHyperlinks(self):
-        return self.doc.Hyperlinks
+        self.forgetFormat()
     
     def getCurrentPosition(self):
+        self.flushText()
         return self.selection.Range.Start
+
+    def cursor(self):
+        return self.selection.Range
     
     def clearFormatting(self):
-        self.selection.ClearFormatting()
+        # applied by flushText, only if it changes anything
+        self.pending_clear = True
+        self.pending_paragraph_style = None
+        self.pending_character_style = None
+        self.font_buffer = set()
+
+    def backspace(self):
+        self.flushText()
+        self.selection.TypeBackspace()
+        self.forgetFormat()
 
     def resetListStartNumber(self):
-        
-        format = self.selection.Style.ParagraphFormat
-        list_template = self.selection.Style.ListTemplate
+        """
+        Restarts the numbering of the list at the cursor. The list template
+        of a list style is configured the first time only, afterwards it is
+        just applied again.
+        """
+        self.flushText()
+        range = self.cursor()
+        style = None
+        name = self.paragraph_style
+        if name is None:
+            style = range.Paragraphs(1).Style
+            name = style.NameLocal
+        if name in self.list_templates:
+            self.stats["list templates reused"] += 1
+        else:
+            if style is None:
+                style = range.Paragraphs(1).Style
+            self.list_templates[name] = self.configureListTemplate(style)
+        range.ListFormat.ApplyListTemplateWithLevel(ListTemplate=self.list_templates[name], 
+                                                    ContinuePreviousList=False,
+                                                    ApplyTo=CST.wdListApplyToThisPointForward, 
+                                                    DefaultListBehavior=CST.wdWord10ListBehavior)
+        self.direct_formatting = True
+
+    def configureListTemplate(self, style):
+        format = style.ParagraphFormat
+        list_template = style.ListTemplate
         list_lvl = list_template.ListLevels(1)
         list_lvl.NumberFormat = "%1."
         list_lvl.TrailingCharacter = CST.wdTrailingTab
@@ -390,15 +973,13 @@ class Word:
         list_lvl.TabPosition = format.TabStops[0].Position
         list_lvl.ResetOnHigher = 0
         list_lvl.StartAt = 1
-        list_lvl.LinkedStyle = self.selection.Style
-        self.selection.Range.ListFormat.ApplyListTemplateWithLevel(ListTemplate=list_template, 
-                                                                   ContinuePreviousList=False,
-                                                                   ApplyTo=CST.wdListApplyToThisPointForward, 
-                                                                   DefaultListBehavior=CST.wdWord10ListBehavior)
+        list_lvl.LinkedStyle = style
+        return list_template
 
     def addOLEObject(self, filename, classType="PowerPoint.Show.8"):
+        self.flushText()
         shape = self.selection.InlineShapes.AddOLEObject(ClassType=classType, 
-                                                         FileName=file, 
+                                                         FileName=filename, 
                                                          LinkToFile=False, 
                                                          DisplayAsIcon=False)
         shape.LockAspectRatio = -1
@@ -406,6 +987,376 @@ class Word:
                      - self.doc.PageSetup.RightMargin 
                      - self.doc.PageSetup.LeftMargin)
         self.selectEnd()
+        self.forgetFormat()
+
+class RangeWord(Word):
+    """
+    Same as Word but the insertion point is a Range built from an offset kept
+    in Python instead of the shared Selection: text and paragraphs are
+    inserted with Range.InsertAfter and getCurrentPosition does not query
+    Word. Character formatting cannot be set on an empty range, it is kept
+    in Python and applied to each piece of inserted text.
+    """
+
+    def __init__(self, templatefile=None, pool=None):
+        Word.__init__(self, templatefile, pool)
+        # characters between the cursor and the end of the document, it does
+        # not change when something is inserted at the cursor, so the cursor
+        # can be found again after insertions of unknown length (see resync)
+        self.position = 0
+        self.tail = self.doc.Content.End
+        # [table, rows, cols, row, col] of the tables we are in
+        self.tables = []
+        self.run_style = CST.wdStyleDefaultParagraphFont
+        self.run_font = set()
+        # formatting of the last inserted text, None means unknown
+        self.last_run = None
+        self.stats["cursor resyncs"] = 0
+
+    def cursor(self):
+        return self.doc.Range(self.position, self.position)
+
+    def jumpTo(self, position):
+        self.position = position
+        self.tail = self.doc.Content.End - position
+        self.forgetFormat()
+
+    def resync(self):
+        self.position = self.doc.Content.End - self.tail
+        self.stats["cursor resyncs"] += 1
+        self.forgetFormat()
+
+    def forgetFormat(self):
+        Word.forgetFormat(self)
+        self.last_run = None
+
+    def addText(self, text):
+        # Word counts a line break as one character
+        Word.addText(self, NEWLINE_REX.sub("\r", text))
+
+    def typeText(self, text):
+        range = self.cursor()
+        range.InsertAfter(text)
+        run = (self.run_style, frozenset(self.run_font))
+        # inserted text takes the formatting of the text before it, the
+        # fonts set on it must be reset unless the new text sets them too
+        if self.last_run is None or not self.last_run[1] <= run[1]:
+            range.Font.Reset()
+        if run[0] != CST.wdStyleDefaultParagraphFont or self.last_run != run:
+            range.Style = self.run_style
+        else:
+            self.stats["formatting calls skipped"] += 1
+        for font in sorted(self.run_font):
+            range.Font.__setattr__(font, True)
+        self.last_run = run
+        self.position += len(text)
+
+    def insertChunk(self, text):
+        self.typeText(text)
+
+    def applyFormat(self):
+        """
+        Paragraph formatting is set on the paragraph at the cursor, character
+        formatting only changes what the next typeText applies.
+        """
+        if self.pending_clear:
+            if self.direct_formatting:
+                self.cursor().ParagraphFormat.Reset()
+                self.direct_formatting = False
+            else:
+                self.stats["formatting calls skipped"] += 1
+            if self.pending_paragraph_style is None:
+                self.pending_paragraph_style = CST.wdStyleNormal
+            self.run_style = CST.wdStyleDefaultParagraphFont
+            self.run_font = set()
+            self.pending_clear = False
+
+        if self.pending_paragraph_style is not None:
+            name = self.styleName(self.pending_paragraph_style)
+            if name == self.paragraph_style:
+                self.stats["formatting calls skipped"] += 1
+            else:
+                self.cursor().Style = self.pending_paragraph_style
+                self.paragraph_style = name
+            self.pending_paragraph_style = None
+
+        if self.pending_character_style is not None:
+            self.run_style = self.pending_character_style
+            self.run_font = set()
+            self.pending_character_style = None
+
+        self.run_font ^= self.font_buffer
+        self.font_buffer = set()
+
+    def newParagraph(self):
+        if self.hasPendingFormat():
+            self.flushText()
+        # the paragraph mark is typed along with the text around it, the new
+        # paragraph keeps the style of the current one
+        self.text_buffer.append("\r")
+
+    def addTable(self, rows, cols, fit=CST.wdAutoFitContent):
+        self.flushText()
+        table = self.doc.Tables.Add(Range=self.cursor(), 
+                                    NumRows=rows, 
+                                    NumColumns=cols, 
+                                    DefaultTableBehavior=0, 
+                                    AutoFitBehavior=fit)
+        self.tables.append([table, rows, cols, 1, 1])
+        self.jumpTo(table.Cell(1, 1).Range.Start)
+        return table
+
+    def move(self, direction, unit=CST.wdCell, count=1):
+        self.flushText()
+        if self.tables and unit == CST.wdCell and direction in ("left", "right"):
+            current = self.tables[-1]
+            table, rows, cols, row, col = current
+            index = (row - 1) * cols + (col - 1)
+            if direction == "right":
+                index += count
+            else:
+                index = max(index - count, 0)
+            row, col = index // cols + 1, index % cols + 1
+            if row > rows:
+                # like the selection, moving right from the last cell adds a row
+                table.Rows.Add()
+                current[1] = rows = row
+            current[3:] = [row, col]
+            self.jumpTo(table.Cell(row, col).Range.Start)
+        elif self.tables and direction == "down" and unit != CST.wdCell:
+            # leaving the table
+            table = self.tables.pop()[0]
+            self.jumpTo(table.Range.End)
+        else:
+            self.cursor().Select()
+            Word.move(self, direction, unit, count)
+            self.jumpTo(self.selection.Start)
+
+    def endTable(self):
+        table = Word.endTable(self)
+        # the tabs and paragraph marks became cell and row markers
+        self.resync()
+        return table
+
+    def insertField(self, doc_property_name):
+        self.flushText()
+        self.fields.add("DOCPROPERTY")
+        self.doc.Fields.Add(Range=self.cursor(), 
+                            Type=CST.wdFieldEmpty, 
+                            Text="DOCPROPERTY  %s " % doc_property_name, 
+                            PreserveFormatting=True)
+        self.resync()
+
+    def insertTableOfContents(self, depth=3):
+        self.flushText()
+        self.fields.add("TOC")
+        # see Word.insertTableOfContents for the parameters
+        TRUE = 1
+        toc = self.doc.TablesOfContents.Add(Range=self.cursor(), 
+                                            RightAlignPageNumbers=True, 
+                                            UseHeadingStyles=True,
+                                            UpperHeadingLevel=1,
+                                            LowerHeadingLevel=depth, 
+                                            IncludePageNumbers=True, 
+                                            AddedStyles="",
+                                            UseHyperlinks=TRUE, 
+                                            HidePageNumbersInWeb=TRUE, 
+                                            UseOutlineLevels=False)
+        toc.TabLeader = CST.wdTabLeaderDots
+        self.doc.TablesOfContents.Format = CST.wdIndexIndent
+        self.resync()
+
+    def insertPageBreak(self):
+        self.flushText()
+        self.cursor().InsertBreak(7)
+        self.resync()
+
+    def setAlignment(self, alignment):
+        self.flushText()
+        self.cursor().ParagraphFormat.Alignment = alignment
+        self.direct_formatting = True
+
+    def insertImage(self, image_path, size=None):
+        self.flushText()
+        image = self.doc.InlineShapes.AddPicture(FileName=image_path, LinkToFile=False, 
+                                                 SaveWithDocument=True, Range=self.cursor())
+        if size is not None:
+            image.Width, image.Height = size
+        # an inline shape is one character
+        self.position += 1
+        self.forgetFormat()
+
+        return image
+
+    def addCaption(self, text, figure, auto=False, label="Figure"):
+        self.flushText()
+        if auto:
+            self.fields.add("SEQ")
+            figure.Select()
+            self.selection.InsertCaption(Label=label, TitleAutoText="", Title=" " + text,
+                                         Position=1, ExcludeLabel=0)
+            self.resync()
+        else:
+            self.cursor().Style = CST.wdStyleCaption
+            self.forgetFormat()
+        self.newParagraph()
+        self.clearFormatting()
+
+    def insertHyperlink(self, text, target, internal=False):
+        self.flushText()
+        if internal or target.startswith("_"):
+            self.doc.Hyperlinks.Add(Anchor=self.cursor(), Address="",
+                                    SubAddress=target, ScreenTip="", TextToDisplay=text)
+        else:
+            self.doc.Hyperlinks.Add(Anchor=self.cursor(), Address=target, 
+                                    SubAddress="", ScreenTip="", TextToDisplay=text)
+        # the field code is counted in the positions
+        self.resync()
+
+    def getCurrentPosition(self):
+        self.flushText()
+        return self.position
+
+    def backspace(self):
+        self.flushText()
+        self.doc.Range(self.position - 1, self.position).Delete()
+        self.position -= 1
+        self.forgetFormat()
+
+    def addOLEObject(self, filename, classType="PowerPoint.Show.8"):
+        self.flushText()
+        self.cursor().Select()
+        Word.addOLEObject(self, filename, classType)
+        self.resync()
+
+    def insertFile(self, filename):
+        Word.insertFile(self, filename)
+        self.resync()
+
+class TemplateFields:
+    """
+    Where a template has fields: in the main story (body), in its text
+    boxes (body_shapes), in headers and footers (headers) and in their text
+    boxes (header_shapes). toc tells if it has a table of contents.
+    """
+
+    def __init__(self, default=False):
+        self.body = self.body_shapes = default
+        self.headers = self.header_shapes = default
+        self.toc = default
+
+def analyzeTemplate(path):
+    """
+    Returns the TemplateFields of a .dotx/.docx template, None if it cannot
+    be read without Word (.dot templates). Results are cached until the
+    file changes.
+    """
+    if path is None or not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    cached = _template_cache.get(path)
+    if cached is not None and cached[:2] == (stat.st_mtime, stat.st_size):
+        return cached[2]
+    info = None
+    # .dot files are not zips but can embed one (their theme)
+    if zipfile.is_zipfile(path):
+        package = zipfile.ZipFile(path)
+        try:
+            if "word/document.xml" in package.namelist():
+                info = readTemplateFields(package)
+        finally:
+            package.close()
+    _template_cache[path] = (stat.st_mtime, stat.st_size, info)
+    return info
+
+def readTemplateFields(package):
+    info = TemplateFields()
+    for name in package.namelist():
+        part = os.path.basename(name)
+        if name == "word/document.xml":
+            story, shapes = "body", "body_shapes"
+        elif name.startswith("word/") and part.startswith(("header", "footer")) and part.endswith(".xml"):
+            story, shapes = "headers", "header_shapes"
+        else:
+            continue
+        xml = package.read(name).decode("utf-8")
+        if FIELD_REX.search(TEXT_BOX_REX.sub("", xml)):
+            setattr(info, story, True)
+        for box in TEXT_BOX_REX.findall(xml):
+            if FIELD_REX.search(box):
+                setattr(info, shapes, True)
+        if story == "body" and TOC_REX.search(xml):
+            info.toc = True
+    return info
+
+def checkCOM():
+    if WIN is None:
+        raise ImportError("PyWin32 is required to drive Microsoft Office, "
+                          "use --backend=docx to generate documents without Word")
+
+def readChunks(path, encoding="utf-8", size=CHUNK_SIZE):
+    """
+    Yields the text of a file by chunks of about size characters, cut at
+    the end of a line unless the line is longer than size.
+    """
+    f = io.open(path, "r", encoding=encoding, errors="replace")
+    try:
+        while True:
+            chunk = f.read(size)
+            if not chunk:
+                break
+            if not chunk.endswith("\n"):
+                chunk += f.readline(size)
+            yield chunk
+    finally:
+        f.close()
+
+def splitChunks(text, size=CHUNK_SIZE):
+    """
+    Yields a text by chunks of about size characters, cut at the end of a
+    line unless the line is longer than size.
+    """
+    start = 0
+    while start < len(text):
+        end = text.find("\n", start + size, start + 2 * size)
+        if end < 0:
+            end = min(start + 2 * size, len(text))
+        else:
+            end += 1
+        yield text[start:end]
+        start = end
+
+def processId(app, doc):
+    """
+    Returns the id of the process of a Word application, found from the
+    window of a document (one window per document since Word 2013) or else
+    from a main window whose title ends with the caption of the application.
+    """
+    try:
+        hwnd = doc.ActiveWindow.Hwnd
+    except Exception:
+        # Word 2010 and older have no Hwnd property
+        hwnd = 0
+    if not hwnd:
+        caption = app.Caption
+        windows = []
+        def collect(handle, _):
+            if (win32gui.GetClassName(handle) == "OpusApp"
+                    and win32gui.GetWindowText(handle).endswith(caption)):
+                windows.append(handle)
+            return True
+        win32gui.EnumWindows(collect, None)
+        hwnd = windows and windows[0] or 0
+    if not hwnd:
+        raise RuntimeError("Cannot find the process of %s, its memory cannot be "
+                           "checked (--word-max-memory)" % app.Caption)
+    return win32process.GetWindowThreadProcessId(hwnd)[1]
+
+def processMemory(pid):
+    """
+    Returns the memory used by a process, in bytes.
+    """
+    return psutil.Process(pid).memory_info().rss
 
 def CentimetersToPoints(centimeters):
     return centimeters * 28.35
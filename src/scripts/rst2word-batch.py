@@ -0,0 +1,18 @@
+#!C:\tools\python26\python.exe
+
+"""
+Generates Microsoft Word documents from many reStructuredText sources in
+one run (see rst2wordlib.batch).
+"""
+
+try:
+    import locale
+    locale.setlocale(locale.LC_ALL, '')
+except:
+    pass
+import sys
+from rst2wordlib.batch import main
+
+# the worker processes of --jobs import this script again on Windows
+if __name__ == "__main__":
+    sys.exit(main())
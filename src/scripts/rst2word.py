@@ -23,10 +23,12 @@ from docutils.core import publish_cmdline_to_binary
 description = ('Generates Microsoft Word documents from standalone reStructuredText '
                'sources.  ' + docutils.core.default_description)
 
-publish_cmdline_to_binary(reader=docutils.readers.standalone.Reader(), 
-                          parser=docutils.parsers.rst.Parser(), 
-                          writer=rst2wordlib.Writer(), 
-                          enable_exit_status=1, 
-                          usage=docutils.core.default_usage, 
-                          description=description, 
-                          destination_class=docutils.io.NullOutput)
+# the worker processes of --split-jobs import this script again on Windows
+if __name__ == "__main__":
+    publish_cmdline_to_binary(reader=docutils.readers.standalone.Reader(), 
+                              parser=docutils.parsers.rst.Parser(), 
+                              writer=rst2wordlib.Writer(), 
+                              enable_exit_status=1, 
+                              usage=docutils.core.default_usage, 
+                              description=description, 
+                              destination_class=docutils.io.NullOutput)